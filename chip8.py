@@ -1,21 +1,40 @@
 import time
 import sys
+import argparse
 import importlib
+import multiprocessing
 
 import chip8_state
 import chip8_interpreter
+import chip8_compiler
 import chip8_input
+import chip8_rewind
+import chip8_profile
+import chip8_movie
+import chip8_trace
+import chip8_shared
 
 # NOTE: These constants will be moved to a configuration file at some point
 
-platform_layers = {'sdl': 'platform_sdl'}
+platform_layers = {'sdl': 'platform_sdl',
+                   'null': 'platform_null'} # Headless, for running without a display
 
 PLATFORM_LAYER = 'sdl'
 
-if PLATFORM_LAYER in platform_layers.keys():
-    platform_layer = importlib.import_module(platform_layers[PLATFORM_LAYER])
-else:
-    sys.exit("Unknown platform layer")
+FRAME_RATE = 60 # Hz. The delay and sound timers tick once per frame.
+
+INSTRUCTIONS_PER_FRAME = 10 # CPU speed. 10 per frame is 600 instructions per second.
+
+ENGINES = ('interpreter', # chip8_interpreter, one opcode at a time
+           'compiler')    # chip8_compiler, cached basic blocks
+
+ENGINE = 'interpreter'
+
+TURBO_PRESENT_EVERY = None # In turbo, draw every Kth frame, or None to draw
+                           # at most FRAME_RATE frames per second of real time
+
+MAX_FRAME_SKIP = 4 # With adaptive frame skip, frames that can go undrawn in a
+                   # row before the game is allowed to slow down instead
 
 PLATFORM_OPTIONS = {'window': {
                                'window_scale': 16,
@@ -26,6 +45,10 @@ PLATFORM_OPTIONS = {'window': {
                                'volume'      : .5, # in percent
                                'tonehz'      : 440, # Note A4
                                'wavetype'    : 'sine' # sine or square
+                              },
+                    'null':   {
+                               'input_script': (), # (tick, keycode, type) tuples
+                               'quit_after'  : None # ticks, or None to run forever
                               }
                    }
 
@@ -65,73 +88,373 @@ KEYMAP  = {'0'      :   0, # Number key
            'kp_e'   : 0xE,
            'f'      : 0xF,
            'kp_f'   : 0xF,
+           'f5'     : 'save_state', # Snapshot to the state file
+           'f9'     : 'load_state', # Restore from the state file
+           '\b'     : 'rewind', # Backspace. Runs backwards while held
+           '\t'     : 'turbo', # Tab. Toggles fast-forward
+           'f10'    : 'dump_profile', # Only with --profile
+           'f11'    : 'dump_trace', # Only with --trace
            'escape' : 'exit',
            'ctrl+q' : 'exit' # Modifier + letter key
            }
            # Other possibilites include multiple modifiers. Modifiers themselves can't be bound directly.
 
 
-def chip8(program, keymap, state=None):
+def load_platform_layer(name):
+    '''Import and return the platform layer module registered as name in
+platform_layers. Only the layer that is used gets imported.'''
+    if name in platform_layers.keys():
+        return importlib.import_module(platform_layers[name])
+    else:
+        sys.exit("Unknown platform layer: {}".format(name))
+
+
+def save_state(state, path):
+    '''Write a snapshot of state to the file at path.'''
+    with open(path, 'wb') as state_file:
+        state_file.write(state.snapshot())
+
+
+def load_state(state, path):
+    '''Restore state from a snapshot in the file at path.'''
+    with open(path, 'rb') as state_file:
+        state.restore(state_file.read())
+
+
+def chip8(program, keymap, state=None, platform=PLATFORM_LAYER,
+          instructions_per_frame=INSTRUCTIONS_PER_FRAME, engine=ENGINE,
+          uncapped=False, state_path=None,
+          rewind_seconds=chip8_rewind.REWIND_SECONDS, profiler=None,
+          turbo=False, turbo_present_every=TURBO_PRESENT_EVERY,
+          adaptive_frame_skip=False, recorder=None, player=None,
+          tracer=None, trace_path=None, run_ahead=0):
     if not state:
         state = chip8_state.State(program)
 
+    # A movie only replays correctly if nothing but the keypad changes the
+    # state between frames, so rewinding and loading states are turned off
+    # while recording or playing one.
+    if player:
+        player.start(state)
+        instructions_per_frame = player.instructions_per_frame
+    if recorder:
+        recorder.start(state)
+    movie = recorder or player
+    if movie:
+        rewind_seconds = 0
+
+    platform_layer = load_platform_layer(platform)
     platform_interface = platform_layer.Interface(state, PLATFORM_OPTIONS)
+    platform_interface.input.bind_keymap(keymap)
 
-    countdown = 0
+    if engine == 'compiler':
+        run = chip8_compiler.Compiler(state).run
+    else:
+        run = chip8_interpreter.run
+
+    frame_time = 1 / FRAME_RATE
     beeping = False
     running = True
+    snapshot = None # Used by save_state and load_state without a state_path
+    rewind = chip8_rewind.Rewind(rewind_seconds, FRAME_RATE) if rewind_seconds else None
+    rewinding = False
+    unpresented = 0 # Frames emulated since the screen was last drawn
 
-    t1 = time.perf_counter()
+    deadline = time.perf_counter()
+    presented = deadline # When the screen was last drawn
     while running:
-        events = platform_interface.input.get_events()
-        for event in events:
-            if event.type == chip8_input.QUIT:
+        for event_type, action in platform_interface.input.get_actions():
+            if event_type == chip8_input.QUIT or action == 'exit':
                 running = False
-            elif event.keycode in keymap.keys():
-                action = keymap[event.keycode]
-                if action == 'exit':
-                    running = False
-                elif (type(action) == int and 
-                      action in range(len(state.keypad))):
-                    state.keypad[action] = event.type
-                else:
-                    message = "Unhandled action: {}".format(action)
-                    raise chip8_input.UnhandledActionError(message, action)
+            elif action == 'save_state':
+                if event_type == chip8_input.KEYDOWN:
+                    if state_path:
+                        try:
+                            save_state(state, state_path)
+                        except OSError as error:
+                            print("Couldn't save state: {}".format(error), file=sys.stderr)
+                    else:
+                        snapshot = state.snapshot()
+            elif action == 'load_state':
+                if event_type == chip8_input.KEYDOWN and not movie:
+                    if state_path:
+                        # A missing or bad file shouldn't end the session
+                        try:
+                            load_state(state, state_path)
+                        except (OSError, ValueError) as error:
+                            print("Couldn't load state: {}".format(error), file=sys.stderr)
+                    elif snapshot:
+                        state.restore(snapshot)
+            elif action == 'dump_profile':
+                if profiler and event_type == chip8_input.KEYDOWN:
+                    print(profiler.report(), file=sys.stderr)
+            elif action == 'turbo':
+                if event_type == chip8_input.KEYDOWN:
+                    turbo = not turbo
+                    deadline = time.perf_counter()
+            elif action == 'dump_trace':
+                if tracer and event_type == chip8_input.KEYDOWN:
+                    tracer.dump(trace_path)
+            elif action == 'rewind':
+                rewinding = rewind is not None and event_type == chip8_input.KEYDOWN
+            elif (type(action) == int and
+                  action in range(len(state.keypad))):
+                if not player:
+                    state.keypad[action] = event_type
+            else:
+                message = "Unhandled action: {}".format(action)
+                raise chip8_input.UnhandledActionError(message, action)
         if not running:
             break
 
-        delay_was = state.delay
-        chip8_interpreter.step(state)
-
-        platform_interface.video.update_screen(state)
-
-        #### Timer End ####
-        t2 = time.perf_counter()
+        if rewinding:
+            # Step back one frame, but keep the keys that are held now
+            keypad = bytes(state.keypad)
+            rewind.pop(state)
+            state.keypad[:] = keypad
+        else:
+            if player and not player.play(state):
+                break
+            if recorder:
+                recorder.record(state)
 
-        countdown += (t2 - t1) # Add timer value to countdown
+            if rewind is not None:
+                rewind.push(state)
 
-        t1 = time.perf_counter()
-        #### Timer Start ####
+            run(state, instructions_per_frame)
 
-        if countdown >= 1/60:
-            if delay_was >= state.delay: # This ensures that at least 1/60 of
-                                         # a second is elapsed before the
-                                         # delay timer starts ticking. Else
-                                         # a delay of 1 might not have an
-                                         # effect.
-                state.delay = max(0, state.delay - 1)
             if state.sound > 0:
-                if not beeping:
+                if not beeping and not turbo:
                     platform_interface.audio.beep(state.sound * 1000/60)
                     beeping = True
-                state.sound -= 1
             else:
                 beeping = False
 
-            countdown = 0
+            chip8_interpreter.tick_timers(state)
+
+        # Timers have ticked once for this emulated frame whether or not
+        # it is drawn, so skipping frames never changes the game's speed.
+        unpresented += 1
+        now = time.perf_counter()
+        if turbo:
+            if turbo_present_every:
+                present = unpresented >= turbo_present_every
+            else:
+                present = now - presented >= frame_time
+        elif adaptive_frame_skip and not uncapped:
+            # Don't draw a frame that is already late, so that the time
+            # goes towards catching up instead
+            present = now < deadline + frame_time or unpresented > MAX_FRAME_SKIP
+        else:
+            present = True
+
+        if present:
+            if run_ahead and not rewinding:
+                # Show where the game will be run_ahead frames from now if
+                # the keys stay as they are, hiding the frames of lag
+                # built into many games. The future frames are emulated
+                # without sound or drawing, then thrown away.
+                snapshot_now = state.snapshot()
+                for _ in range(run_ahead):
+                    chip8_interpreter.run_frame(state, instructions_per_frame, run)
+                platform_interface.video.update_screen(state)
+                state.restore(snapshot_now)
+            else:
+                platform_interface.video.update_screen(state)
+            presented = now
+            unpresented = 0
+
+        if not (uncapped or turbo):
+            # Sleep off whatever is left of this frame. If the host has
+            # fallen too far behind, start counting again from now instead
+            # of running a burst of frames to catch up.
+            deadline += frame_time
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            elif remaining < -frame_time * (MAX_FRAME_SKIP if adaptive_frame_skip else 1):
+                deadline = time.perf_counter()
+
+
+def chip8_split(program, keymap, platform=PLATFORM_LAYER,
+                instructions_per_frame=INSTRUCTIONS_PER_FRAME, engine=ENGINE,
+                uncapped=False):
+    '''Like chip8(), but with the program running in a process of its own
+(see chip8_shared), so that drawing and input never hold up emulation. Only
+the keypad and exit actions work, since everything else needs the state,
+which lives in the other process.'''
+    state = chip8_state.State(b'') # What the front end shows
+    frame = chip8_shared.SharedFrame()
+    core = multiprocessing.Process(target=chip8_shared.core,
+                                   args=(frame.name, program, instructions_per_frame,
+                                         engine, FRAME_RATE, uncapped),
+                                   daemon=True)
+    core.start()
+    try:
+        platform_layer = load_platform_layer(platform)
+        platform_interface = platform_layer.Interface(state, PLATFORM_OPTIONS)
+        platform_interface.input.bind_keymap(keymap)
+
+        frame_time = 1 / FRAME_RATE
+        sequence = None
+        beeps = 0
+        running = True
+        deadline = time.perf_counter()
+        while running and core.is_alive():
+            for event_type, action in platform_interface.input.get_actions():
+                if event_type == chip8_input.QUIT or action == 'exit':
+                    running = False
+                elif (type(action) == int and
+                      action in range(len(frame.keypad))):
+                    frame.keypad[action] = event_type
+
+            new_frame = frame.read(state, sequence)
+            if new_frame:
+                sequence, new_beeps, beep_length = new_frame
+                if new_beeps != beeps:
+                    platform_interface.audio.beep(beep_length * 1000/60)
+                    beeps = new_beeps
+                platform_interface.video.update_screen(state)
+
+            # The front end always runs at the frame rate. The core keeps
+            # its own time, and frames it publishes in between are skipped.
+            deadline += frame_time
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            elif remaining < -frame_time:
+                deadline = time.perf_counter()
+
+        crashed = frame.get('status') == chip8_shared.CRASHED
+    finally:
+        frame.set('quit', 1)
+        core.join(1)
+        if core.is_alive():
+            core.terminate()
+        frame.close()
+
+    if crashed:
+        sys.exit("The emulation core crashed")
 
 
 if __name__ == '__main__':
-    with open(sys.argv[1], "rb") as binary_file:
+    parser = argparse.ArgumentParser(description='Run a CHIP-8 program.')
+    parser.add_argument('program', help='path to the program to run')
+    parser.add_argument('--platform', default=PLATFORM_LAYER,
+                        choices=sorted(platform_layers.keys()),
+                        help='platform layer to use (default: %(default)s)')
+    parser.add_argument('--ipf', type=int, default=INSTRUCTIONS_PER_FRAME,
+                        help='instructions per 1/60s frame (default: %(default)s)')
+    parser.add_argument('--engine', default=ENGINE, choices=ENGINES,
+                        help='execution engine (default: %(default)s)')
+    parser.add_argument('--frames', type=int, metavar='N',
+                        help='with --platform null, quit after N frames')
+    parser.add_argument('--input-script', metavar='PATH',
+                        help='with --platform null, take the keyboard input from '
+                             'the script in PATH (see platform_null)')
+    parser.add_argument('--uncapped', action='store_true',
+                        help="don't wait for the next frame, run as fast as possible")
+    parser.add_argument('--split', action='store_true',
+                        help='run the program in a process of its own, apart '
+                             'from drawing and input (only the keypad and exit '
+                             'keys work)')
+    parser.add_argument('--turbo', action='store_true',
+                        help='start in fast-forward, toggled with the turbo key')
+    parser.add_argument('--turbo-present-every', type=int, metavar='K',
+                        default=TURBO_PRESENT_EVERY,
+                        help='in fast-forward, draw every Kth frame '
+                             '(default: at most {} per second)'.format(FRAME_RATE))
+    parser.add_argument('--frame-skip', action='store_true',
+                        help="skip drawing frames when the host can't keep up, "
+                             "instead of slowing down")
+    parser.add_argument('--run-ahead', type=int, metavar='FRAMES', default=0,
+                        help='show the screen this many frames ahead, to hide '
+                             "the game's own input lag (default: %(default)s)")
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the keypad to a movie file at PATH')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='play back the movie file at PATH, ignoring the keypad')
+    parser.add_argument('--state-file', metavar='PATH',
+                        help='file for the save_state and load_state keys '
+                             '(default: the program path plus .state)')
+    parser.add_argument('--rewind', type=float, metavar='SECONDS',
+                        default=chip8_rewind.REWIND_SECONDS,
+                        help='length of the rewind buffer, 0 to disable '
+                             '(default: %(default)s)')
+    instrumentation = parser.add_mutually_exclusive_group()
+    instrumentation.add_argument('--profile', action='store_true',
+                                 help='profile opcodes and addresses, and print the '
+                                      'results at exit or on the dump_profile key')
+    instrumentation.add_argument('--trace', metavar='PATH',
+                                 help='keep a trace of the last {} opcodes, and write '
+                                      'it to PATH at exit, on a crash or on the '
+                                      'dump_trace key'.format(chip8_trace.TRACE_SIZE))
+    args = parser.parse_args()
+
+    if args.platform == 'null':
+        if args.frames is not None:
+            PLATFORM_OPTIONS['null']['quit_after'] = args.frames
+        if args.input_script:
+            platform_null = load_platform_layer('null')
+            try:
+                script = platform_null.load_input_script(args.input_script)
+            except (OSError, ValueError) as error:
+                parser.error(str(error))
+            PLATFORM_OPTIONS['null']['input_script'] = script
+    elif args.frames is not None or args.input_script:
+        parser.error('--frames and --input-script need --platform null')
+
+    if args.run_ahead and (args.profile or args.trace):
+        # The frames run ahead are thrown away, but would still be counted
+        # by the profiler and fill up the trace
+        parser.error('--run-ahead can\'t be used with --profile or --trace')
+
+    if args.split:
+        # These all need the state, which lives in the core's process
+        unsupported = ['--' + dest.replace('_', '-')
+                       for dest in ('turbo', 'turbo_present_every', 'frame_skip',
+                                    'run_ahead', 'record', 'replay', 'state_file',
+                                    'rewind', 'profile', 'trace')
+                       if getattr(args, dest) != parser.get_default(dest)]
+        if unsupported:
+            parser.error('--split can\'t be used with {}'.format(', '.join(unsupported)))
+
+    with open(args.program, "rb") as binary_file:
         program = binary_file.read()
-    chip8(program, KEYMAP)
\ No newline at end of file
+
+    profiler = None
+    if args.profile:
+        profiler = chip8_profile.Profiler()
+        profiler.enable()
+
+    tracer = None
+    if args.trace:
+        tracer = chip8_trace.Tracer()
+        tracer.enable()
+
+    recorder = chip8_movie.Recorder(args.ipf) if args.record else None
+    player = chip8_movie.Player.load(args.replay) if args.replay else None
+
+    try:
+        if args.split:
+            chip8_split(program, KEYMAP, platform=args.platform,
+                        instructions_per_frame=args.ipf, engine=args.engine,
+                        uncapped=args.uncapped)
+        else:
+            chip8(program, KEYMAP, platform=args.platform,
+                  instructions_per_frame=args.ipf, engine=args.engine,
+                  uncapped=args.uncapped,
+                  state_path=args.state_file or args.program + '.state',
+                  rewind_seconds=args.rewind, profiler=profiler,
+                  turbo=args.turbo, turbo_present_every=args.turbo_present_every,
+                  adaptive_frame_skip=args.frame_skip,
+                  recorder=recorder, player=player,
+                  tracer=tracer, trace_path=args.trace,
+                  run_ahead=args.run_ahead)
+    finally:
+        if tracer:
+            tracer.dump(args.trace)
+        if recorder and recorder.snapshot is not None:
+            recorder.save(args.record)
+        if profiler:
+            print(profiler.report(), file=sys.stderr)
@@ -0,0 +1,307 @@
+'''Runs many CHIP-8 machines in lockstep, using NumPy.
+
+A Batch holds N machines as structure-of-arrays buffers, one row per machine,
+and executes one opcode on every machine per step. The machines are grouped
+by opcode family and each group is executed with vectorized gathers and
+scatters, so the cost of a step grows with the number of distinct opcode
+families in flight rather than with N. This suits running the same program
+under many different inputs.
+
+The opcodes behave as they do in chip8_interpreter, with two differences.
+CXNN draws from a NumPy generator, so results don't match a State run
+through the interpreter. And where the interpreter would raise or exit (an
+unknown opcode, 0NNN, a stack overflow, an address past the end of memory)
+only that machine stops: its entry in Batch.halted is set and it is skipped
+from then on. The machines are plain 64x32 CHIP-8, so SUPER-CHIP opcodes
+stop them the same way.
+
+NumPy is only needed by this module.
+'''
+
+import numpy as np
+
+import chip8_state
+
+SCREEN_WIDTH = 64
+SCREEN_HEIGHT = 32
+
+
+class Batch:
+    def __init__(self, program, count, seed=None):
+        self.count = count
+        self.memory = np.zeros((count, 0x1000), np.uint8)
+        self.memory[:, :len(chip8_state.FONT)] = chip8_state.FONT
+        big_font = slice(chip8_state.BIG_FONT_START,
+                         chip8_state.BIG_FONT_START + len(chip8_state.BIG_FONT))
+        self.memory[:, big_font] = chip8_state.BIG_FONT
+        self.memory[:, 0x200:0x200 + len(program)] = np.frombuffer(bytes(program), np.uint8)
+
+        self.register = np.zeros((count, 16), np.uint8)
+        self.I = np.zeros(count, np.int64)
+        self.pc = np.full(count, 0x200, np.int64)
+        self.delay = np.zeros(count, np.uint8)
+        self.sound = np.zeros(count, np.uint8)
+        self.stack = np.zeros((count, chip8_state.STACK_SIZE), np.int64)
+        self.sp = np.zeros(count, np.int64)
+        self.keypad = np.zeros((count, 16), np.uint8)
+        self.screen = np.zeros((count, SCREEN_HEIGHT, SCREEN_WIDTH), np.uint8)
+        self.halted = np.zeros(count, bool)
+
+        self.rng = np.random.default_rng(seed)
+
+        self._families = {0x0: self._x0,
+                          0x1: self._x1NNN,
+                          0x2: self._x2NNN,
+                          0x3: self._x3XNN,
+                          0x4: self._x4XNN,
+                          0x5: self._x5XY0,
+                          0x6: self._x6XNN,
+                          0x7: self._x7XNN,
+                          0x8: self._x8,
+                          0x9: self._x9XY0,
+                          0xA: self._xANNN,
+                          0xB: self._xBNNN,
+                          0xC: self._xCXNN,
+                          0xD: self._xDXYN,
+                          0xE: self._xE,
+                          0xF: self._xF}
+
+    def step(self):
+        '''Execute the next opcode on every machine that hasn't halted.'''
+        running = np.flatnonzero(~self.halted)
+        pc = self.pc[running]
+        memory = self.memory
+        opcode = ((memory[running, pc & 0xFFF].astype(np.int64) << 8) |
+                  memory[running, (pc + 1) & 0xFFF])
+        self.pc[running] = pc + 2
+
+        family = opcode >> 12
+        for f in np.unique(family):
+            selected = family == f
+            m = running[selected]
+            op = opcode[selected]
+            self._families[f](m, op, (op >> 8) & 0xF, (op >> 4) & 0xF)
+
+    def run(self, instructions):
+        '''Execute `instructions` opcodes on every machine.'''
+        for _ in range(instructions):
+            self.step()
+
+    def tick_timers(self):
+        '''Count the delay and sound timers down by one on every machine.'''
+        np.subtract(self.delay, 1, out=self.delay, where=self.delay > 0)
+        np.subtract(self.sound, 1, out=self.sound, where=self.sound > 0)
+
+    def run_frame(self, instructions):
+        '''Emulate one 60Hz frame on every machine, as
+chip8_interpreter.run_frame does for one.'''
+        self.run(instructions)
+        self.tick_timers()
+
+    def to_state(self, i):
+        '''Return a chip8_state.State copy of machine i.'''
+        state = chip8_state.State(b'')
+        state.memory[:] = self.memory[i].tobytes()
+        state.register[:] = self.register[i].tobytes()
+        state.I = int(self.I[i])
+        state.pc = int(self.pc[i])
+        state.delay = int(self.delay[i])
+        state.sound = int(self.sound[i])
+        state.sp = int(self.sp[i])
+        for level in range(len(state.stack)):
+            state.stack[level] = int(self.stack[i, level])
+        state.keypad[:] = self.keypad[i].tobytes()
+        for y, row in enumerate(np.packbits(self.screen[i], axis=1)):
+            state.screen[y] = int.from_bytes(row.tobytes(), 'big')
+        return state
+
+    # Opcode families. Each is passed the indices m of the machines that are
+    # executing it, and their opcodes, X and Y fields. Fields are read back
+    # from the registers after every write, because X or Y may be F.
+
+    def _skip(self, m, condition):
+        skipped = m[condition]
+        self.pc[skipped] = (self.pc[skipped] + 2) % 0x1000
+
+    def _x0(self, m, op, X, Y):
+        nnn = op & 0xFFF
+        clear = m[nnn == 0x0E0]
+        self.screen[clear] = 0
+
+        ret = m[nnn == 0x0EE]
+        underflow = self.sp[ret] == 0
+        self.halted[ret[underflow]] = True
+        ret = ret[~underflow]
+        self.sp[ret] -= 1
+        self.pc[ret] = self.stack[ret, self.sp[ret]]
+
+        self.halted[m[(nnn != 0x0E0) & (nnn != 0x0EE)]] = True # 0NNN
+
+    def _x1NNN(self, m, op, X, Y):
+        self.pc[m] = op & 0xFFF
+
+    def _x2NNN(self, m, op, X, Y):
+        overflow = self.sp[m] == self.stack.shape[1]
+        self.halted[m[overflow]] = True
+        m = m[~overflow]
+        op = op[~overflow]
+        self.stack[m, self.sp[m]] = self.pc[m]
+        self.sp[m] += 1
+        self.pc[m] = op & 0xFFF
+
+    def _x3XNN(self, m, op, X, Y):
+        self._skip(m, self.register[m, X] == (op & 0xFF))
+
+    def _x4XNN(self, m, op, X, Y):
+        self._skip(m, self.register[m, X] != (op & 0xFF))
+
+    def _x5XY0(self, m, op, X, Y):
+        self._skip(m, self.register[m, X] == self.register[m, Y])
+
+    def _x6XNN(self, m, op, X, Y):
+        self.register[m, X] = op & 0xFF
+
+    def _x7XNN(self, m, op, X, Y):
+        self.register[m, X] = (self.register[m, X].astype(np.int64) + (op & 0xFF)) % 0x100
+
+    def _x8(self, m, op, X, Y):
+        V = self.register
+        N = op & 0xF
+        for n in np.unique(N):
+            selected = N == n
+            k, x, y = m[selected], X[selected], Y[selected]
+            vx = V[k, x].astype(np.int64)
+            vy = V[k, y].astype(np.int64)
+            if n == 0x0:
+                V[k, x] = vy
+            elif n == 0x1:
+                V[k, x] = vx | vy
+            elif n == 0x2:
+                V[k, x] = vx & vy
+            elif n == 0x3:
+                V[k, x] = vx ^ vy
+            elif n == 0x4:
+                V[k, 0xF] = vx + vy > 0xFF
+                V[k, x] = (V[k, x].astype(np.int64) + V[k, y]) % 0x100
+            elif n == 0x5:
+                V[k, 0xF] = vy <= vx
+                V[k, x] = (V[k, x].astype(np.int64) - V[k, y]) % 0x100
+            elif n == 0x6:
+                V[k, 0xF] = vx & 1
+                V[k, x] = V[k, x] >> 1
+            elif n == 0x7:
+                V[k, x] = (vy - vx) & 0xFF
+                V[k, 0xF] = vy >= vx
+            elif n == 0xE:
+                V[k, 0xF] = vx >> 7
+                V[k, x] = (V[k, x].astype(np.int64) << 1) & 0xFF
+            else:
+                self.halted[k] = True
+
+    def _x9XY0(self, m, op, X, Y):
+        self._skip(m, self.register[m, X] != self.register[m, Y])
+
+    def _xANNN(self, m, op, X, Y):
+        self.I[m] = op & 0xFFF
+
+    def _xBNNN(self, m, op, X, Y):
+        self.I[m] = ((op & 0xFFF) + self.register[m, 0]) % 0x1000
+
+    def _xCXNN(self, m, op, X, Y):
+        self.register[m, X] = self.rng.integers(0, 0x100, len(m)) & (op & 0xFF)
+
+    def _xDXYN(self, m, op, X, Y):
+        wide = (op & 0xF) == 0 # SUPER-CHIP 16x16 sprites
+        if wide.any():
+            self.halted[m[wide]] = True
+            m, op, X, Y = m[~wide], op[~wide], X[~wide], Y[~wide]
+        V = self.register
+        x = V[m, X].astype(np.int64) % SCREEN_WIDTH
+        y = V[m, Y].astype(np.int64) % SCREEN_HEIGHT
+        rows = np.minimum(op & 0xF, SCREEN_HEIGHT - y)
+        I = self.I[m]
+
+        out_of_memory = (I + rows > 0x1000) & (rows > 0)
+        self.halted[m[out_of_memory]] = True
+        keep = ~out_of_memory
+        m, x, y, rows, I = m[keep], x[keep], y[keep], rows[keep], I[keep]
+
+        # Every (machine, sprite row, sprite column) at once. Pixels in rows
+        # past N or columns past the right edge are masked out, which clips
+        # the sprite just as the shifts in the interpreter do.
+        if len(m) == 0 or rows.max() <= 0:
+            V[m, 0xF] = 0
+            return
+        row = np.arange(rows.max())
+        column = np.arange(8)
+        in_sprite = row[None, :] < rows[:, None]
+        addresses = np.where(in_sprite, I[:, None] + row[None, :], 0)
+        sprite = np.unpackbits(self.memory[m[:, None], addresses][:, :, None], axis=2)
+        screen_x = x[:, None, None] + column[None, None, :]
+        screen_y = np.broadcast_to(y[:, None, None] + row[None, :, None], sprite.shape)
+        set_pixels = (sprite == 1) & in_sprite[:, :, None] & (screen_x < SCREEN_WIDTH)
+
+        owner = np.broadcast_to(np.arange(len(m))[:, None, None], sprite.shape)[set_pixels]
+        machine = m[owner]
+        pixel_y = screen_y[set_pixels]
+        pixel_x = np.broadcast_to(screen_x, sprite.shape)[set_pixels]
+
+        collided = np.zeros(len(m), bool)
+        collided[owner[self.screen[machine, pixel_y, pixel_x] == 1]] = True
+        self.screen[machine, pixel_y, pixel_x] ^= 1
+        V[m, 0xF] = collided
+
+    def _xE(self, m, op, X, Y):
+        key = self.register[m, X]
+        bad_key = key > 0xF
+        self.halted[m[bad_key]] = True
+        m, op, key = m[~bad_key], op[~bad_key], key[~bad_key]
+        pressed = self.keypad[m, key] != 0
+        # Anything other than EX9E behaves as EXA1, as in the interpreter
+        self._skip(m, np.where((op & 0xFF) == 0x9E, pressed, ~pressed))
+
+    def _xF(self, m, op, X, Y):
+        V = self.register
+        NN = op & 0xFF
+        for nn in np.unique(NN):
+            selected = NN == nn
+            k, x = m[selected], X[selected]
+            if nn == 0x07:
+                V[k, x] = self.delay[k]
+            elif nn == 0x0A:
+                pressed = self.keypad[k].any(axis=1)
+                V[k[pressed], x[pressed]] = self.keypad[k[pressed]].argmax(axis=1)
+                self.pc[k[~pressed]] -= 2
+            elif nn == 0x15:
+                self.delay[k] = V[k, x]
+            elif nn == 0x18:
+                self.sound[k] = V[k, x]
+            elif nn == 0x1E:
+                V[k, 0xF] = self.I[k] + V[k, x] > 0xFFF
+                self.I[k] = (self.I[k] + V[k, x]) % 0x1000
+            elif nn == 0x29:
+                self.I[k] = V[k, x].astype(np.int64) * 5
+            elif nn == 0x33:
+                out_of_memory = self.I[k] + 3 > 0x1000
+                self.halted[k[out_of_memory]] = True
+                k, x = k[~out_of_memory], x[~out_of_memory]
+                value = V[k, x]
+                I = self.I[k]
+                self.memory[k, I] = value // 100
+                self.memory[k, I + 1] = value // 10 % 10
+                self.memory[k, I + 2] = value % 10
+            elif nn == 0x55 or nn == 0x65:
+                out_of_memory = self.I[k] + x + 1 > 0x1000
+                self.halted[k[out_of_memory]] = True
+                k, x = k[~out_of_memory], x[~out_of_memory]
+                I = self.I[k]
+                for r in range(16):
+                    copying = r <= x
+                    c = k[copying]
+                    if nn == 0x55:
+                        self.memory[c, I[copying] + r] = V[c, r]
+                    else:
+                        V[c, r] = self.memory[c, I[copying] + r]
+                self.I[k] = I + x + 1
+            else:
+                self.halted[k] = True
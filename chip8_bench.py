@@ -0,0 +1,253 @@
+'''Benchmarks for the interpreter, with machine readable output so results
+can be compared between commits.
+
+    python3 chip8_bench.py --output before.json
+    (change something)
+    python3 chip8_bench.py --compare before.json
+
+Microbenchmarks time every handler reachable from chip8_interpreter.MAPPING,
+both called directly and through the x0/x8/xE/xF dispatchers, in opcodes per
+second. Macrobenchmarks run small synthetic programs that each stress one
+kind of work for a fixed number of frames, on each engine, and report
+opcodes and frames per second.
+'''
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+import chip8_state
+import chip8_interpreter as interp
+import chip8_compiler
+
+MICRO_ITERATIONS = 20000
+MACRO_FRAMES = 600
+INSTRUCTIONS_PER_FRAME = 100
+REPEAT = 3 # Best of
+
+
+def assemble(*words):
+    '''Turn 16 bit opcodes into program bytes.'''
+    return b''.join(word.to_bytes(2, 'big') for word in words)
+
+
+# One representative opcode per handler. The optional reset is called before
+# each execution, to put back anything the opcode changes that would stop
+# it from being run again (the stack pointer, for example).
+def _push_return(state):
+    state.stack[0] = 0x200
+    state.sp = 1
+
+def _reset_stack(state):
+    state.sp = 0
+
+def _reset_I(state):
+    state.I = 0x300
+
+def _reset_pc(state):
+    state.pc = 0x202
+
+MICRO = {'x00E0': (0x00E0, None),
+         'x00EE': (0x00EE, _push_return),
+         'x00CN': (0x00C4, None),
+         'x00FB': (0x00FB, None),
+         'x00FC': (0x00FC, None),
+         'x00FD': (0x00FD, _reset_pc),
+         'x00FE': (0x00FE, None),
+         'x00FF': (0x00FF, None),
+         'x1NNN': (0x1200, None),
+         'x2NNN': (0x2200, _reset_stack),
+         'x3XNN': (0x3012, None),
+         'x4XNN': (0x4012, None),
+         'x5XY0': (0x5010, None),
+         'x6XNN': (0x6012, None),
+         'x7XNN': (0x7012, None),
+         'x8XY0': (0x8010, None),
+         'x8XY1': (0x8011, None),
+         'x8XY2': (0x8012, None),
+         'x8XY3': (0x8013, None),
+         'x8XY4': (0x8014, None),
+         'x8XY5': (0x8015, None),
+         'x8XY6': (0x8016, None),
+         'x8XY7': (0x8017, None),
+         'x8XYE': (0x801E, None),
+         'x9XY0': (0x9010, None),
+         'xANNN': (0xA300, None),
+         'xBNNN': (0xB300, None),
+         'xCXNN': (0xC0FF, None),
+         'xDXY0': (0xD010, None),
+         'xDXY1': (0xD011, None),
+         'xDXY8': (0xD018, None),
+         'xDXYF': (0xD01F, None),
+         'xEX9E': (0xE09E, None),
+         'xEXA1': (0xE0A1, None),
+         'xFX07': (0xF007, None),
+         'xFX0A': (0xF00A, None),
+         'xFX15': (0xF015, None),
+         'xFX18': (0xF018, None),
+         'xFX1E': (0xF01E, _reset_I),
+         'xFX29': (0xF029, None),
+         'xFX30': (0xF030, None),
+         'xFX33': (0xF033, None),
+         'xFX55': (0xFF55, _reset_I),
+         'xFX65': (0xFF65, _reset_I),
+         'xFX75': (0xFF75, None),
+         'xFX85': (0xFF85, None)}
+
+MACRO = {# Sprites drawn all over the screen
+         'draw': assemble(0x6205, 0xF229,         # I = font sprite for 5
+                          0xD015, 0x7003, 0x7102, # draw, move
+                          0x1204),
+         # Binary coded decimal conversion of a counter
+         'bcd': assemble(0xA300,
+                         0xF033, 0x7001,
+                         0x1202),
+         # Copying all sixteen registers out to memory and back
+         'memory': assemble(0xA300, 0xFF55,
+                            0xA300, 0xFF65,
+                            0x1200),
+         # Calls, returns and jumps
+         'jumps': assemble(0x2206, 0x1200,
+                           0x0000,
+                           0x120A,        # 0x206
+                           0x0000,
+                           0x00EE),       # 0x20A
+         # Register arithmetic and skips
+         'alu': assemble(0x6011, 0x6122,
+                         0x8014, 0x8115, 0x8016, 0x801E,
+                         0x3000, 0x7001,
+                         0x1204)}
+
+
+def _best(function):
+    '''Return the shortest of REPEAT timings of function().'''
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def micro_state():
+    state = chip8_state.State(b'')
+    state.I = 0x300
+    state.keypad[0] = 1
+    return state
+
+
+def micro_benchmark(word, reset, iterations=MICRO_ITERATIONS, dispatch=False):
+    '''Return opcodes per second for the handler of word. With dispatch, the
+handler is reached through MAPPING and the x0/x8/xE/xF dispatchers, as
+execute_opcode did before opcodes were pre-decoded.'''
+    state = micro_state()
+    instruction = interp.DECODE[word]
+    handler = interp.MAPPING[word >> 12] if dispatch else instruction.handler
+
+    def loop():
+        for _ in range(iterations):
+            if reset:
+                reset(state)
+            handler(state, instruction)
+
+    return iterations / _best(loop)
+
+
+def macro_benchmark(program, engine, frames=MACRO_FRAMES,
+                    instructions_per_frame=INSTRUCTIONS_PER_FRAME):
+    '''Return (opcodes per second, frames per second) for running program
+headless on engine.'''
+    executed = 0
+
+    def loop():
+        nonlocal executed
+        state = chip8_state.State(program)
+        if engine == 'compiler':
+            run = chip8_compiler.Compiler(state).run
+        else:
+            run = interp.run
+        executed = 0
+        for _ in range(frames):
+            executed += interp.run_frame(state, instructions_per_frame, run)
+
+    elapsed = _best(loop)
+    return executed / elapsed, frames / elapsed
+
+
+def run_benchmarks(micro_iterations=MICRO_ITERATIONS, macro_frames=MACRO_FRAMES):
+    results = {'python': platform.python_version(),
+               'commit': _git_commit(),
+               'micro': {},
+               'macro': {}}
+
+    for name, (word, reset) in MICRO.items():
+        results['micro'][name] = {'ops_per_sec': micro_benchmark(word, reset, micro_iterations)}
+        if word >> 12 in (0x0, 0x8, 0xE, 0xF):
+            results['micro'][name]['dispatched_ops_per_sec'] = micro_benchmark(word, reset, micro_iterations, dispatch=True)
+
+    for name, program in MACRO.items():
+        results['macro'][name] = {}
+        for engine in ('interpreter', 'compiler'):
+            ips, fps = macro_benchmark(program, engine, macro_frames)
+            results['macro'][name][engine] = {'instructions_per_sec': ips,
+                                              'frames_per_sec': fps}
+    return results
+
+
+def compare(old, new):
+    '''Print the change in every rate from the results old to new.'''
+    def rates(results):
+        for name, values in results['micro'].items():
+            for key, value in values.items():
+                yield 'micro/{}/{}'.format(name, key), value
+        for name, engines in results['macro'].items():
+            for engine, values in engines.items():
+                for key, value in values.items():
+                    yield 'macro/{}/{}/{}'.format(name, engine, key), value
+
+    old_rates = dict(rates(old))
+    for name, value in rates(new):
+        if name in old_rates:
+            change = (value / old_rates[name] - 1) * 100
+            print('{:50} {:14.0f} {:+7.1f}%'.format(name, value, change))
+        else:
+            print('{:50} {:14.0f}     new'.format(name, value))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CHIP-8 interpreter.')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results as JSON to FILE instead of stdout')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print the change from earlier results in FILE')
+    parser.add_argument('--micro-iterations', type=int, default=MICRO_ITERATIONS)
+    parser.add_argument('--macro-frames', type=int, default=MACRO_FRAMES)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.micro_iterations, args.macro_frames)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            compare(json.load(old_file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+'''An alternative to chip8_interpreter.step, which compiles straight-line runs
+of CHIP-8 code (basic blocks) into Python functions and caches them by start
+address.
+
+A block ends at the first opcode that can change the flow of control (jumps,
+skips, calls, returns), at DXYN and FX0A, and at opcodes that write to memory
+(FX33, FX55), so that self-modifying programs never run a stale block. Simple
+register opcodes are inlined with their operands baked in as constants;
+everything else calls the handler from chip8_interpreter, so there is only
+one definition of what each opcode does.
+'''
+
+import chip8_state
+import chip8_interpreter as interp
+
+MAX_BLOCK_LENGTH = 64 # Opcodes compiled into a single block, at most.
+
+# Inlined opcodes. Each template is a list of source lines, formatted with
+# the Instruction fields. `r` is state.register. These must stay equivalent
+# to the handlers in chip8_interpreter.
+INLINE = {interp.x6XNN: ['r[{X}] = {NN}'],
+          interp.x7XNN: ['r[{X}] = (r[{X}] + {NN}) % 0x100'],
+          interp.x8XY0: ['r[{X}] = r[{Y}]'],
+          interp.x8XY1: ['r[{X}] = r[{X}] | r[{Y}]'],
+          interp.x8XY2: ['r[{X}] = r[{X}] & r[{Y}]'],
+          interp.x8XY3: ['r[{X}] = r[{X}] ^ r[{Y}]'],
+          interp.x8XY4: ['r[0xF] = int(r[{X}] + r[{Y}] > 0xFF)',
+                         'r[{X}] = (r[{X}] + r[{Y}]) % 0x100'],
+          interp.x8XY5: ['r[0xF] = 0 if r[{Y}] > r[{X}] else 1',
+                         'r[{X}] = (r[{X}] - r[{Y}]) % 0x100'],
+          interp.x8XY6: ['r[0xF] = r[{X}] & 1',
+                         'r[{X}] = r[{X}] >> 1'],
+          interp.x8XYE: ['r[0xF] = r[{X}] >> 7',
+                         'r[{X}] = (r[{X}] << 1) & 0xFF'],
+          interp.xANNN: ['state.I = {NNN}'],
+          interp.xFX07: ['r[{X}] = state.delay'],
+          interp.xFX15: ['state.delay = r[{X}]'],
+          interp.xFX18: ['state.sound = r[{X}]'],
+          interp.xFX1E: ['r[0xF] = int(state.I + r[{X}] > 0xFFF)',
+                         'state.I = (state.I + r[{X}]) % 0x1000'],
+          interp.xFX29: ['state.I = r[{X}] * 5'],
+          interp.xFX30: ['state.I = {big_font} + r[{X}] * 10']}
+
+# Block terminators that are inlined. The templates set state.pc themselves.
+# {next} is the address after the opcode, {skip} the one after that.
+INLINE_BRANCHES = {interp.x1NNN: ['state.pc = {NNN}'],
+                   interp.x3XNN: ['state.pc = {skip} if r[{X}] == {NN} else {next}'],
+                   interp.x4XNN: ['state.pc = {skip} if r[{X}] != {NN} else {next}'],
+                   interp.x5XY0: ['state.pc = {skip} if r[{X}] == r[{Y}] else {next}'],
+                   interp.x9XY0: ['state.pc = {skip} if r[{X}] != r[{Y}] else {next}'],
+                   interp.xEX9E: ['state.pc = {skip} if state.keypad[r[{X}]] else {next}'],
+                   interp.xEXA1: ['state.pc = {skip} if not state.keypad[r[{X}]] else {next}']}
+
+# Block terminators that are handed off to the interpreter.
+BRANCHES = {interp.x0NNN,
+            interp.x00EE,
+            interp.x00FD,
+            interp.x2NNN,
+            interp.xBNNN,
+            interp.xDXYN,
+            interp.xFX0A,
+            interp.xFX33,
+            interp.xFX55,
+            # Undecodable opcodes, which fail in the dispatcher
+            interp.x8,
+            interp.xF}
+
+
+class Compiler:
+    '''Compiles and caches blocks for a single chip8_state.State. The cache is
+kept in sync with state.memory through state.write_watchers, so anything
+else that writes to memory directly should call flush().'''
+    def __init__(self, state):
+        self.state = state
+        self._blocks = {}
+        self._covering = [None] * 0x1000 # Block start addresses, by address
+        self._decode = interp.DECODE # The table blocks were compiled against
+        state.write_watchers.append(self.invalidate)
+
+    def step(self, state):
+        '''Run the block starting at state.pc, compiling it first if needed.
+Returns the number of opcodes executed.'''
+        if interp.DECODE is not self._decode:
+            self._recompile()
+        try:
+            block = self._blocks[state.pc]
+        except KeyError:
+            block = self._blocks[state.pc] = self.compile(state.pc)
+        return block(state)
+
+    def run(self, state, instructions):
+        '''Execute exactly `instructions` opcodes, as chip8_interpreter.run
+does. When the budget runs out partway through a block, the block's
+partial() version stops it there. Returns the number of opcodes executed.'''
+        if interp.DECODE is not self._decode:
+            self._recompile()
+        blocks = self._blocks
+        executed = 0
+        state.idle = 0
+        while executed < instructions:
+            try:
+                block = blocks[state.pc]
+            except KeyError:
+                block = blocks[state.pc] = self.compile(state.pc)
+            if executed + block.length <= instructions:
+                executed += block(state)
+            else:
+                executed += block.partial(state, instructions - executed)
+            if state.idle:
+                # Skip whole laps of the spin-wait, as chip8_interpreter.run
+                # does
+                remaining = instructions - executed
+                executed += remaining - remaining % state.idle
+                state.idle = 0
+        return executed
+
+    def invalidate(self, start, stop):
+        '''Drop any cached block containing an address in [start, stop).'''
+        covering = self._covering
+        for address in range(max(start, 0), min(stop, 0x1000)):
+            starts = covering[address]
+            if starts:
+                covering[address] = None
+                for block_start in starts:
+                    block = self._blocks.pop(block_start, None)
+                    if block is None:
+                        continue
+                    # Forget the block at every other address it covers,
+                    # or recompiling it would list it there twice
+                    for covered in range(block_start, block.stop):
+                        others = covering[covered]
+                        if others:
+                            others.remove(block_start)
+                            if not others:
+                                covering[covered] = None
+
+    def flush(self):
+        '''Drop every cached block.'''
+        self._blocks.clear()
+        self._covering = [None] * 0x1000
+
+    def _recompile(self):
+        # chip8_interpreter.instrument() or uninstrument() swapped the
+        # dispatch table, so cached blocks call the wrong handlers
+        self.flush()
+        self._decode = interp.DECODE
+
+    def compile(self, start):
+        '''Compile the block starting at address start into a function
+taking a state and returning the number of opcodes it executed. The
+function's partial attribute is a version taking a state and a budget,
+which stops after that many opcodes if the budget is less than the
+function's length.'''
+        memory = self.state.memory
+        namespace = {}
+        opcodes = [] # (source lines, address after the opcode) per opcode
+
+        address = start
+        count = 0
+        while True:
+            # Opcodes are sorted by their plain handlers, since instrument()
+            # may have wrapped the ones in DECODE. Handlers that are called
+            # come from DECODE, so they are the instrumented ones.
+            word = (memory[address] << 8) | memory[address + 1]
+            handler = interp.PLAIN_DECODE[word].handler
+            instruction = interp.DECODE[word]
+            fields = instruction._asdict()
+            fields['next'] = address + 2
+            fields['skip'] = (address + 4) % 0x1000
+            fields['big_font'] = chip8_state.BIG_FONT_START
+            count += 1
+            lines = []
+            opcodes.append((lines, address + 2))
+
+            if handler in INLINE:
+                lines.extend(line.format(**fields) for line in INLINE[handler])
+            elif handler in INLINE_BRANCHES:
+                lines.extend(line.format(**fields) for line in INLINE_BRANCHES[handler])
+                if handler is interp.x1NNN and address - 4 <= instruction.NNN <= address:
+                    # A possible spin-wait, as in chip8_interpreter.x1NNN
+                    namespace['idle_loop'] = interp.idle_loop
+                    lines.append('state.idle = idle_loop(state, {}, {})'.format(address, instruction.NNN))
+                break
+            else:
+                # Handlers may read or change state.pc, so it has to be
+                # correct before they are called.
+                namespace['h{}'.format(count)] = instruction.handler
+                namespace['i{}'.format(count)] = instruction
+                lines.append('state.pc = {}'.format(address + 2))
+                lines.append('h{0}(state, i{0})'.format(count))
+                if handler in BRANCHES:
+                    break
+
+            address += 2
+            if count == MAX_BLOCK_LENGTH or address + 1 >= len(memory):
+                lines.append('state.pc = {}'.format(address))
+                break
+
+        # Both versions run the same opcodes. partial() checks the budget
+        # after each one but the last, which only the branch can have
+        # changed state.pc past.
+        source = ['def block(state):',
+                  '    r = state.register']
+        partial = ['def partial(state, budget):',
+                   '    r = state.register']
+        for executed, (lines, following) in enumerate(opcodes, 1):
+            source.extend('    ' + line for line in lines)
+            partial.extend('    ' + line for line in lines)
+            if executed < count:
+                partial.extend(['    if budget == {}:'.format(executed),
+                                '        state.pc = {}'.format(following),
+                                '        return {}'.format(executed)])
+        source.append('    return {}'.format(count))
+        partial.append('    return {}'.format(count))
+
+        stop = min(start + count * 2, 0x1000)
+        for covered in range(start, stop):
+            if self._covering[covered] is None:
+                self._covering[covered] = [start]
+            else:
+                self._covering[covered].append(start)
+
+        code = compile('\n'.join(source + partial), '<block 0x{:03X}>'.format(start), 'exec')
+        exec(code, namespace)
+        block = namespace['block']
+        block.partial = namespace['partial']
+        block.length = count
+        block.stop = stop # End of the addresses it covers
+        return block
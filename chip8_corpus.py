@@ -0,0 +1,130 @@
+'''Runs every .ch8 program in a directory headless, for a fixed number of
+frames, spread over a pool of processes. Writes one JSON report per program
+with a hash of the screen after every frame, a hash of the final state, the
+number of opcodes executed and the wall time, so that runs of two versions
+of the interpreter can be compared with diff.
+
+    python3 chip8_corpus.py /path/to/roms --frames 600 --output reports/
+
+Input is scripted with --input, a JSON file holding a list of
+[frame, key, pressed] entries: at the start of that frame, hex key 0-F is
+pressed (1) or released (0).
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+import chip8_state
+import chip8_interpreter
+import chip8_compiler
+
+FRAMES = 600 # 10 seconds of emulated time
+INSTRUCTIONS_PER_FRAME = 10
+SEED = 0 # For State.rng, so CXNN is the same on every run
+
+
+def screen_hash(state):
+    '''Return a short hex digest of the screen.'''
+    return hashlib.blake2b(state.screen, digest_size=8).hexdigest()
+
+
+def run_program(path, frames=FRAMES, instructions_per_frame=INSTRUCTIONS_PER_FRAME,
+                script=(), engine='interpreter', seed=SEED):
+    '''Run the program at path headless and return its report as a dict.'''
+    with open(path, 'rb') as binary_file:
+        program = binary_file.read()
+
+    inputs = {}
+    for frame, key, pressed in script:
+        inputs.setdefault(frame, []).append((key, pressed))
+
+    state = chip8_state.State(program, seed)
+    if engine == 'compiler':
+        run = chip8_compiler.Compiler(state).run
+    else:
+        run = chip8_interpreter.run
+
+    report = {'program': os.path.basename(path),
+              'frames': 0,
+              'instructions': 0,
+              'frame_hashes': [],
+              'error': None}
+
+    start = time.perf_counter()
+    try:
+        for frame in range(frames):
+            for key, pressed in inputs.get(frame, ()):
+                state.keypad[key] = pressed
+            report['instructions'] += chip8_interpreter.run_frame(state, instructions_per_frame, run)
+            report['frame_hashes'].append(screen_hash(state))
+            report['frames'] += 1
+    except (Exception, SystemExit) as error:
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+    report['wall_time'] = time.perf_counter() - start
+    report['state_hash'] = hashlib.sha256(state.snapshot()).hexdigest()
+
+    return report
+
+
+def _run_task(task):
+    path, options = task
+    return path, run_program(path, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a directory of CHIP-8 programs headless and report on them.')
+    parser.add_argument('directory', help='directory searched recursively for .ch8 files')
+    parser.add_argument('--frames', type=int, default=FRAMES,
+                        help='frames to run each program for (default: %(default)s)')
+    parser.add_argument('--ipf', type=int, default=INSTRUCTIONS_PER_FRAME,
+                        help='instructions per frame (default: %(default)s)')
+    parser.add_argument('--engine', default='interpreter', choices=('interpreter', 'compiler'),
+                        help='execution engine (default: %(default)s)')
+    parser.add_argument('--input', metavar='FILE',
+                        help='JSON list of [frame, key, pressed] entries')
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help='seed for random numbers from CXNN (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--output', metavar='DIR', default='corpus_reports',
+                        help='directory for the reports (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    paths = sorted(os.path.join(root, name)
+                   for root, dirs, names in os.walk(args.directory)
+                   for name in names if name.lower().endswith('.ch8'))
+    if not paths:
+        sys.exit("No .ch8 files found in {}".format(args.directory))
+
+    script = ()
+    if args.input:
+        with open(args.input) as script_file:
+            script = [tuple(entry) for entry in json.load(script_file)]
+
+    options = {'frames': args.frames,
+               'instructions_per_frame': args.ipf,
+               'script': script,
+               'engine': args.engine,
+               'seed': args.seed}
+
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.jobs) as pool:
+        for path, report in pool.imap_unordered(_run_task, [(path, options) for path in paths]):
+            relative = os.path.relpath(path, args.directory)
+            name = os.path.splitext(relative)[0].replace(os.sep, '_') + '.json'
+            with open(os.path.join(args.output, name), 'w') as report_file:
+                json.dump(report, report_file, indent=1)
+            print('{program}: {frames} frames, {instructions} instructions, '
+                  '{wall_time:.2f}s{0}'.format(' ({})'.format(report['error']) if report['error'] else '',
+                                               **report))
+    print('{} programs in {:.2f}s'.format(len(paths), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@
 needed to interact with the codebase.'''
 
 import tempfile
+import bisect
 import os
+import re
 
 from subprocess import call
 from types import SimpleNamespace as DummyState
@@ -12,13 +14,16 @@ import chip8
 import chip8_input
 import chip8_state
 import chip8_interpreter
-import platform_sdl
+import chip8_movie
+import chip8_rewind
+
+CHECKPOINT_INTERVAL = 10000 # Opcodes between Debugger checkpoints
 
 
 def print_screen(state):
     '''Utility to print out state.screen to the console'''
     for y in range(state.SCREEN_HEIGHT):
-        for x in state.screen[y*state.SCREEN_WIDTH:(y+1)*state.SCREEN_WIDTH]:
+        for x in state.row_pixels(y):
             print('█' if x else '░', end='')
         print()
 
@@ -62,7 +67,7 @@ Stack
            state.I, state.pc, state.delay, state.sound,
            current_opcode,
            descriptions[current_opcode]))
-    for i in state.stack:
+    for i in state.stack[:state.sp]:
         print(format(i, '03X'))
 
 
@@ -87,6 +92,7 @@ def step_out(state, handle_delay=True):
 
 def debug_sdl(state):
     '''Setup, run, and clean up after chip8.chip8()'''
+    import platform_sdl
     chip8.chip8(None, chip8.KEYMAP, state)
     platform_sdl.sdl2.SDL_Quit()
 
@@ -107,12 +113,312 @@ def init_state(filename):
 
     return state
 
+def save_state(state, filename):
+    '''Write a snapshot of state to filename.'''
+    chip8.save_state(state, filename)
+
+
+def load_state(filename):
+    '''Create a State object from a snapshot saved in filename.'''
+    with open(filename, 'rb') as state_file:
+        return chip8_state.State.from_snapshot(state_file.read())
+
+def compile_condition(expression):
+    '''Compile a Python expression about the state, such as
+"V3 == 0x10 and I > 0x300", into a function taking a state and returning
+the expression's value. V0-VF, I, pc, delay and sound are the registers,
+and M[address] is memory.'''
+    source = re.sub(r'\bV([0-9A-Fa-f])\b', r'r[0x\1]', expression)
+    source = re.sub(r'\b(I|pc|delay|sound)\b', r'state.\1', source)
+    source = re.sub(r'\bM\[', 'state.memory[', source)
+    lines = ['def predicate(state):',
+             '    r = state.register',
+             '    return ({})'.format(source)]
+    namespace = {}
+    exec(compile('\n'.join(lines), '<condition {}>'.format(expression), 'exec'), namespace)
+    return namespace['predicate']
+
+
+class Debugger:
+    '''Runs a state at close to the speed of chip8_interpreter.run until it
+hits a breakpoint (the pc reaching an address), a watchpoint (an opcode
+writing to an address) or a condition (see compile_condition), and can go
+back to any earlier opcode.
+
+    debugger = Debugger(state)
+    debugger.break_at(0x2A4)
+    debugger.watch(0x300, 0x310)
+    debugger.break_if('VA > 0x3F')
+    print(debugger.run())
+    print_state(state)
+    debugger.step_back()
+
+Going back restores the nearest checkpoint, taken every checkpoint_interval
+opcodes, and runs forward from it. Checkpoints hold State.rng, so CXNN
+repeats itself, and keypad changes are logged as they happen, so the run
+forward is the same as the first one. A smaller interval makes going back
+faster and uses more memory. After changing the state by hand, call
+forget_future(), or the log will be replayed over the change.'''
+    def __init__(self, state, instructions_per_frame=chip8.INSTRUCTIONS_PER_FRAME,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.state = state
+        self.instructions_per_frame = instructions_per_frame
+        self.checkpoint_interval = checkpoint_interval
+        self.breakpoints = bytearray(0x1000) # 1 at breakpoint addresses
+        self.watchpoints = bytearray(0x1000) # 1 at watched addresses
+        self.conditions = [] # (expression, predicate) pairs
+        self.executed = 0 # Opcodes run since the debugger was created
+        self.position = 0 # Opcodes run so far in the current frame
+        self.frames = 0 # Frames started
+        self._in_frame = False # Whether the current frame's input is in
+        self._running = False
+        self._written = None
+
+        # Everything from the furthest point reached, the horizon, back is
+        # known. Below it, input comes from the log instead of the player.
+        self._horizon = (0, 0) # (executed, frames)
+        self._inputs = {} # executed to keypad mask, where it changed
+        self._input_points = [] # The keys of _inputs, in order
+        self._mask = chip8_movie.keypad_mask(state.keypad)
+        self._checkpoints = [] # (executed, position, frames, in frame, keyframe, pages)
+        self._keyframe = None
+        self._checkpoint()
+
+        state.write_watchers.append(self._watch)
+
+    def break_at(self, address):
+        self.breakpoints[address] = 1
+
+    def clear_break(self, address):
+        self.breakpoints[address] = 0
+
+    def watch(self, start, stop=None):
+        '''Stop after any opcode that writes to memory[start:stop], or just
+memory[start] if stop is None.'''
+        if stop is None:
+            stop = start + 1
+        self.watchpoints[start:stop] = b'\x01' * (stop - start)
+
+    def clear_watch(self, start, stop=None):
+        if stop is None:
+            stop = start + 1
+        self.watchpoints[start:stop] = bytes(stop - start)
+
+    def break_if(self, expression):
+        self.conditions.append((expression, compile_condition(expression)))
+
+    def clear_conditions(self):
+        self.conditions.clear()
+
+    def _watch(self, start, stop):
+        if self._running and any(self.watchpoints[start:stop]):
+            self._written = (start, stop)
+
+    def run(self, frames=None, player=None):
+        '''Run until something is hit, or for `frames` frames, and return why
+it stopped as a string. The timers tick every instructions_per_frame
+opcodes, as in chip8.chip8(). If player is a chip8_movie.Player, it sets the
+keypad at the start of every frame that hasn't been run before.
+
+The opcode at a breakpoint hasn't been executed yet, and running again
+carries on from it. The opcode that hit a watchpoint or condition has.'''
+        stop = None
+        if frames is not None:
+            stop = self.executed + frames * self.instructions_per_frame - self.position
+        return self._execute(stop, player=player) or 'Ran {} frames'.format(frames)
+
+    def step(self, count=1):
+        '''Run count opcodes, ignoring breakpoints.'''
+        self._execute(self.executed + count, check=False)
+
+    def step_back(self, count=1):
+        '''Go back count opcodes.'''
+        self.travel(max(self.executed - count, 0))
+
+    def run_back(self):
+        '''Go back to the last time something was hit, and return why as a
+string, as run() does. Stays put if nothing was.'''
+        now = self.executed
+        for index in range(self._checkpoint_before(now - 1), -1, -1):
+            end = now
+            if index + 1 < len(self._checkpoints):
+                end = min(end, self._checkpoints[index + 1][0])
+            self._restore(index)
+            last = None
+            resuming = False
+            while self.executed < end:
+                reason = self._execute(end, resuming=resuming)
+                resuming = True
+                # Watchpoints and conditions are hit after the opcode runs,
+                # so the one that stopped us is at now itself
+                if reason and self.executed < now:
+                    last = (self.executed, reason)
+            if last:
+                self.travel(last[0])
+                return last[1]
+        self.travel(now)
+        return 'Nothing was hit'
+
+    def travel(self, executed):
+        '''Go to the point where `executed` opcodes had been run. Points past
+the furthest one run so far can't be reached.'''
+        if executed > self._horizon[0]:
+            raise ValueError("Can't travel past opcode {}".format(self._horizon[0]))
+        self._restore(self._checkpoint_before(executed))
+        self._execute(executed, check=False)
+
+    def forget_future(self):
+        '''Make the current point the furthest one, dropping the checkpoints
+and input after it.'''
+        executed = self.executed
+        del self._checkpoints[self._checkpoint_before(executed) + 1:]
+        for point in self._input_points[bisect.bisect_right(self._input_points, executed):]:
+            del self._inputs[point]
+        del self._input_points[bisect.bisect_right(self._input_points, executed):]
+        self._horizon = (executed, self.frames)
+        self._mask = chip8_movie.keypad_mask(self.state.keypad)
+        if executed in self._inputs:
+            self._inputs[executed] = self._mask
+        self._keyframe = None
+
+    def _checkpoint_before(self, executed):
+        '''Return the index of the last checkpoint at or before executed.'''
+        points = [checkpoint[0] for checkpoint in self._checkpoints]
+        return max(bisect.bisect_right(points, executed) - 1, 0)
+
+    def _checkpoint(self):
+        '''Take a checkpoint, unless there already is one this far along.'''
+        if self._checkpoints and self._checkpoints[-1][0] >= self.executed:
+            return
+        snapshot = self.state.snapshot()
+        if (self._keyframe is None or
+            len(self._checkpoints) % chip8_rewind.KEYFRAME_INTERVAL == 0):
+            self._keyframe = snapshot
+            pages = None
+        else:
+            pages = chip8_rewind.delta(self._keyframe, snapshot)
+        self._checkpoints.append((self.executed, self.position, self.frames,
+                                  self._in_frame, self._keyframe, pages))
+
+    def _restore(self, index):
+        (self.executed, self.position, self.frames, self._in_frame,
+         keyframe, pages) = self._checkpoints[index]
+        if pages is None:
+            self.state.restore(keyframe)
+        else:
+            self.state.restore(chip8_rewind.apply_delta(keyframe, pages))
+
+    def _input(self):
+        '''Log the keypad if it has changed, or below the horizon, set it
+from the log.'''
+        if (self.executed, self.frames) < self._horizon:
+            mask = self._inputs.get(self.executed)
+            if mask is not None:
+                keypad = self.state.keypad
+                for key in range(len(keypad)):
+                    keypad[key] = (mask >> key) & 1
+        else:
+            mask = chip8_movie.keypad_mask(self.state.keypad)
+            if mask != self._mask:
+                if self.executed not in self._inputs:
+                    self._input_points.append(self.executed)
+                self._inputs[self.executed] = mask
+                self._mask = mask
+
+    def _execute(self, stop, check=True, player=None, resuming=True):
+        '''Run until executed reaches stop, or forever if stop is None.
+Returns why it stopped early as a string, or None. Without check,
+breakpoints, watchpoints and conditions are ignored. With resuming, a
+breakpoint at the first opcode is too, as it is the one last stopped at.'''
+        state = self.state
+        memory = state.memory
+        decode = chip8_interpreter.DECODE
+        if check:
+            breakpoints = self.breakpoints
+            conditions = self.conditions
+        else:
+            breakpoints = bytes(len(self.breakpoints))
+            conditions = ()
+        interval = self.checkpoint_interval
+        self._written = None
+        self._running = check
+        try:
+            self._input()
+            while stop is None or self.executed < stop:
+                if not self._in_frame:
+                    live = (self.executed, self.frames + 1) > self._horizon
+                    if live and player is not None and not player.play(state):
+                        return 'End of movie'
+                    self.frames += 1
+                    self._in_frame = True
+                    if live:
+                        self._horizon = (self.executed, self.frames)
+                    self._input()
+                if self.executed % interval == 0:
+                    self._checkpoint()
+
+                # Run up to whichever comes first of the end of the frame,
+                # the next checkpoint, the next logged input and stop
+                end = min(self.executed + self.instructions_per_frame - self.position,
+                          (self.executed // interval + 1) * interval)
+                if stop is not None:
+                    end = min(end, stop)
+                if self.executed < self._horizon[0]:
+                    end = min(end, self._horizon[0])
+                    index = bisect.bisect_right(self._input_points, self.executed)
+                    if index < len(self._input_points):
+                        end = min(end, self._input_points[index])
+
+                count = end - self.executed
+                try:
+                    for done in range(count):
+                        pc = state.pc
+                        if breakpoints[pc] and not resuming:
+                            return 'Breakpoint at 0x{:03X}'.format(pc)
+                        resuming = False
+
+                        instruction = decode[(memory[pc] << 8) | memory[pc + 1]]
+                        state.pc = pc + 2
+                        instruction.handler(state, instruction)
+
+                        if self._written:
+                            start, written_stop = self._written
+                            done += 1
+                            return 'Watchpoint: 0x{:03X} wrote to 0x{:03X}-0x{:03X}'.format(pc, start, written_stop - 1)
+                        for expression, predicate in conditions:
+                            if predicate(state):
+                                done += 1
+                                return 'Condition {} after 0x{:03X}'.format(expression, pc)
+                    done = count
+                finally:
+                    if count:
+                        self.executed += done
+                        self.position += done
+                        if self.executed > self._horizon[0]:
+                            self._horizon = (self.executed, self.frames)
+
+                if self.executed in self._inputs:
+                    self._input()
+                if self.position == self.instructions_per_frame:
+                    chip8_interpreter.tick_timers(state)
+                    self.position = 0
+                    self._in_frame = False
+        finally:
+            self._running = False
+
+
 class Descriptions:
     def __init__(self):
         self._notes = {}
         self.docstrings = {"0x0NNN":    "Execute machine language subroutine at address {0.NNN:03X}.",
                            "0x00E0":    "Clear the screen.",
                            "0x00EE":    "Return from a subroutine.",
+                           "0x00CN":    "Scroll the screen down {0.N:01X} rows.",
+                           "0x00FB":    "Scroll the screen right 4 pixels.",
+                           "0x00FC":    "Scroll the screen left 4 pixels.",
+                           "0x00FD":    "Exit the program.",
+                           "0x00FE":    "Switch to the 64x32 screen and clear it.",
+                           "0x00FF":    "Switch to the 128x64 screen and clear it.",
                            "0x1NNN":    "Jump to address {0.NNN:03X}.",
                            "0x2NNN":    "Execute subroutine starting at address {0.NNN:03X}.",
                            "0x3XNN":    "Skip the following instruction if the value of register V{0.X:01X} equals {0.NN:02X}.",
@@ -134,6 +440,7 @@ class Descriptions:
                            "0xBNNN":    "Jump to address {0.NNN:03X} + V0.",
                            "0xCXNN":    "Set V{0.X:01X} to a random number with a mask of {0.NN:02X}.",
                            "0xDXYN":    "Draw a sprite at position V{0.X:01X}, V{0.Y:01X} with {0[3]:X} bytes of sprite data starting at the address stored in I. \nSet VF to 01 if any set pixels are changed to unset, and 00 otherwise.",
+                           "0xDXY0":    "Draw a 16x16 sprite at position V{0.X:01X}, V{0.Y:01X} with 32 bytes of sprite data starting at the address stored in I. \nSet VF to 01 if any set pixels are changed to unset, and 00 otherwise.",
                            "0xEX9E":    "Skip the following instruction if the key corresponding to the hex value currently stored in register V{0.X:01X} is pressed.",
                            "0xEXA1":    "Skip the following instruction if the key corresponding to the hex value currently stored in register V{0.X:01X} is not pressed.",
                            "0xFX07":    "Store the current value of the delay timer in register V{0.X:01X}.",
@@ -142,9 +449,12 @@ class Descriptions:
                            "0xFX18":    "Set the sound timer to the value of register V{0.X:01X}.",
                            "0xFX1E":    "Add the value stored in register V{0.X:01X} to register I.",
                            "0xFX29":    "Set I to the memory address of the sprite data corresponding to the hexadecimal digit stored in register V{0.X:01X}.",
+                           "0xFX30":    "Set I to the memory address of the large sprite data corresponding to the hexadecimal digit stored in register V{0.X:01X}.",
                            "0xFX33":    "Store the binary-coded decimal equivalent of the value stored in register V{0.X:01X} at addresses I, I+1, and I+2.",
                            "0xFX55":    "Store the values of registers V0 to V{0.X:01X} inclusive in memory starting at address I. \nI is set to I + {0.X:01X} + 1 after operation.",
-                           "0xFX65":    "Fill registers V0 to V{0.X:01X} inclusive with the values stored in memory starting at address I. \nI is set to I + {0.X:01X} + 1 after operation."}
+                           "0xFX65":    "Fill registers V0 to V{0.X:01X} inclusive with the values stored in memory starting at address I. \nI is set to I + {0.X:01X} + 1 after operation.",
+                           "0xFX75":    "Store the values of registers V0 to V{0.X:01X} inclusive in the RPL user flags.",
+                           "0xFX85":    "Fill registers V0 to V{0.X:01X} inclusive from the RPL user flags."}
 
     def __getitem__(self, opcode):
         '''Return a string documenting the specific opcode passed. If there is
@@ -156,7 +466,10 @@ a note set for opcode, that is included.'''
             try:
                 string = self.docstrings[opcode.__repr__()]
             except KeyError:
-                string = self.docstrings["0x0NNN"]
+                if opcode.NNN >> 4 == 0x0C:
+                    string = self.docstrings["0x00CN"]
+                else:
+                    string = self.docstrings["0x0NNN"]
         elif opcode[0] == 8:
             l_opcode = list(opcode.__repr__())
             l_opcode[3:5] = ['X', 'Y']
@@ -165,6 +478,8 @@ a note set for opcode, that is included.'''
             l_opcode = list(opcode.__repr__())
             l_opcode[3] = 'X'
             string = self.docstrings[''.join(l_opcode)]
+        elif opcode[0] == 0xD and opcode.N == 0:
+            string = self.docstrings["0xDXY0"]
         else:
             string = self.docstrings['0' + chip8_interpreter.MAPPING[opcode[0]].__name__]
 
@@ -212,6 +527,7 @@ forms into an Opcode object'''
 # If debugging a particular file, save typing by setting it here.
 FILENAME = '/home/yuri/Downloads/Chip-8 Pack/Chip-8 Games/Landing.ch8'
 
-state = init_state(FILENAME)
+# Not there on other machines, so don't fail to import without it
+state = init_state(FILENAME) if os.path.exists(FILENAME) else None
 descriptions = Descriptions()
 note = descriptions.annotate
@@ -219,9 +219,24 @@ KEYDOWN = 1
 KEYUP = 0
 QUIT = -1
 
+# Modifier bits of the masks in a compiled keymap
+MOD_CTRL = 1
+MOD_SHIFT = 2
+MOD_ALT = 4
+MOD_SUPER = 8
+
+_MODIFIER_BITS = {'ctrl':  MOD_CTRL,
+                  'shift': MOD_SHIFT,
+                  'alt':   MOD_ALT,
+                  'super': MOD_SUPER}
+
 
 Event = namedtuple('Event', ('type', 'keycode'))
 
+# What Input.get_actions() returns: the keymap action of a key going down
+# or up, or None for QUIT.
+Action = namedtuple('Action', ('type', 'action'))
+
 
 def normalize_keycode(keycode):
     '''Try to normalize key strings. Makes the key string lowercase,
@@ -274,6 +289,24 @@ replace common synonyms, and reorders the modifiers with sorted()'''
     return '+'.join(key_parts)
 
 
+def split_keycode(keycode):
+    '''Split a normalized key string into the key and a mask of MOD_ bits.'''
+    *modifiers, key = keycode.split('+')
+    modmask = 0
+    for modifier in modifiers:
+        modmask |= _MODIFIER_BITS[modifier]
+    return key, modmask
+
+
+def compile_keymap(keymap):
+    '''Turn a keymap of key strings into a dictionary of (key, modmask) to
+action, so that platform layers can look events up without building
+strings. Bad key strings raise KeyCodeError here, once, instead of when
+the key is pressed.'''
+    return {split_keycode(normalize_keycode(keycode)): action
+            for keycode, action in keymap.items()}
+
+
 class KeyCodeError(Exception):
     '''Raised when attempting to process an invalid keycode'''
     def __init__(self, message):
@@ -1,4 +1,4 @@
-'''CHIP-8 has 35 opcodes, which are all two bytes long and stored big-endian. The opcodes are listed below in comments, in hexadecimal and with the following symbols:
+'''CHIP-8 has 35 opcodes, which are all two bytes long and stored big-endian. SUPER-CHIP adds ten more, for a 128x64 screen, scrolling, 16x16 sprites, a large font and the RPL user flags. The opcodes are listed below in comments, in hexadecimal and with the following symbols:
 
     NNN: address
     NN: 8-bit constant
@@ -7,24 +7,80 @@
 '''
 
 import sys
-import random
+
+from array import array
+from collections import namedtuple
+
+import chip8_state
+
+
+def x00E0(state, opcode):  # 0x00E0 Clears the screen
+    state.init_screen()
+
+
+def x00EE(state, opcode):  # 0x00EE Returns from a subroutine
+    if state.sp == 0:
+        raise IndexError("Return with an empty stack")
+    state.sp -= 1
+    state.pc = state.stack[state.sp]
+
+
+def x00CN(state, opcode):  # 0x00CN Scrolls the screen down N rows (SUPER-CHIP)
+    # Whole rows are moved at once, as one slice of the screen array
+    shift = opcode.N * state.row_words
+    if shift:
+        screen = state.screen
+        screen[shift:] = screen[:-shift]
+        screen[:shift] = array('Q', [0]) * shift
+        state.mark_dirty(0, 0, state.SCREEN_WIDTH, state.SCREEN_HEIGHT)
+
+
+def x00FB(state, opcode):  # 0x00FB Scrolls the screen right 4 pixels (SUPER-CHIP)
+    for y in range(state.SCREEN_HEIGHT):
+        state.set_row(y, state.row(y) >> 4)
+    state.mark_dirty(0, 0, state.SCREEN_WIDTH, state.SCREEN_HEIGHT)
+
+
+def x00FC(state, opcode):  # 0x00FC Scrolls the screen left 4 pixels (SUPER-CHIP)
+    mask = (1 << state.SCREEN_WIDTH) - 1
+    for y in range(state.SCREEN_HEIGHT):
+        state.set_row(y, (state.row(y) << 4) & mask)
+    state.mark_dirty(0, 0, state.SCREEN_WIDTH, state.SCREEN_HEIGHT)
+
+
+def x00FD(state, opcode):  # 0x00FD Exits the program (SUPER-CHIP). Here it halts, leaving the screen up
+    state.pc -= 2
+    state.idle = 1 # Nothing will ever change again
+
+
+def x00FE(state, opcode):  # 0x00FE Switches to the 64x32 screen and clears it (SUPER-CHIP)
+    state.set_resolution(*chip8_state.LORES)
+
+
+def x00FF(state, opcode):  # 0x00FF Switches to the 128x64 screen and clears it (SUPER-CHIP)
+    state.set_resolution(*chip8_state.HIRES)
+
+
+def x0NNN(state, opcode):  # 0x0NNN Calls RCA 1802 machine code at address NNN. Not supported here
+    sys.exit("Execution of machine code is not supported.")
 
 
 def x0(state, opcode):
-    if opcode == 0x00E0:   # 0x00E0 Clears the screen
-        state.init_screen()
-    elif opcode == 0x00EE: # 0x00EE Returns from a subroutine
-        state.pc = state.stack.pop()
-    else:                  # Ox0NNN Calls RCA 1802 machine code at address NNN. Not supported here
-        sys.exit("Execution of machine code is not supported.")
+    MAPPING_0.get(opcode.NNN, x0NNN)(state, opcode)
 
 
 def x1NNN(state, opcode):  # 0x1NNN Jump to address NNN.
+    address = state.pc - 2
     state.pc = opcode.NNN
+    if address - 4 <= opcode.NNN <= address:
+        state.idle = idle_loop(state, address, opcode.NNN)
 
 
 def x2NNN(state, opcode):  # 0x2NNN Calls subroutine at address NNN.
-    state.stack.append(state.pc)
+    if state.sp == len(state.stack):
+        raise IndexError("Stack overflow")
+    state.stack[state.sp] = state.pc
+    state.sp += 1
     state.pc = opcode.NNN
 
 
@@ -86,12 +142,11 @@ def x8XY6(state, opcode):  # 0x8XY6 Set VX to VY >> 1. Set VF to the least signi
 
 
 def x8XY7(state, opcode):  # 0x8XY7 Set VX to VY - VX. VF is set to 0 when there's a borrow, and 1 when there isn't.
-    if state.register[opcode.X] > state.register[opcode.Y]:
-        state.register[0xF] = 0
-        state.register[opcode.X] = 0
-    else:
-        state.register[0xF] = 1
-        state.register[opcode.X] = state.register[opcode.Y] - state.register[opcode.X]
+    # Both operands are read before anything is written, since X may be F
+    X = state.register[opcode.X]
+    Y = state.register[opcode.Y]
+    state.register[opcode.X] = (Y - X) & 0xFF
+    state.register[0xF] = 0 if X > Y else 1
 
 
 def x8XYE(state, opcode):  # 0x8XYE Set VX to VY << 1. Set VF to the most significant bit of VY before the operation.
@@ -100,17 +155,7 @@ def x8XYE(state, opcode):  # 0x8XYE Set VX to VY << 1. Set VF to the most signif
 
 
 def x8(state, opcode):
-    mapping = {0x0: x8XY0,
-               0x1: x8XY1,
-               0x2: x8XY2,
-               0x3: x8XY3,
-               0x4: x8XY4,
-               0x5: x8XY5,
-               0x6: x8XY6,
-               0x7: x8XY7,
-               0xE: x8XYE}
-
-    mapping[opcode[3]](state, opcode)
+    MAPPING_8[opcode.N](state, opcode)
 
 
 def x9XY0(state, opcode):  # 0x9XY0 Skips the next instruction if VX doesn't equal VY
@@ -127,7 +172,7 @@ def xBNNN(state, opcode):  # 0xBNNN Jumps to the address NNN plus V0
 
 
 def xCXNN(state, opcode):  # 0xCXNN Set VX to a random number with a mask of NN
-    state.register[opcode.X] = random.randint(0x00, 0xFF) & opcode.NN
+    state.register[opcode.X] = state.rng.randint(0x00, 0xFF) & opcode.NN
 
 
 
@@ -137,32 +182,62 @@ def xDXYN(state, opcode):
     # starting from memory location I; I value doesn’t change after the
     # execution of this instruction. VF is set to 1 if any screen pixels 
     # are flipped from set to unset when the sprite is drawn, and to 0 if
-    # that doesn’t happen
-    sprite = [[int(x) for x in format(state.memory[state.I + y], '08b')] for y in range(opcode[3])]
-
-    state.register[0xF] = 0
-
+    # that doesn’t happen. On SUPER-CHIP, 0xDXY0 draws a 16x16 sprite
+    # instead, two bytes per row.
     width = state.SCREEN_WIDTH
+    height = state.SCREEN_HEIGHT
+    x = state.register[opcode.X] % width
+    y = state.register[opcode.Y] % height
+    memory = state.memory
+    I = state.I
+    collision = 0
+
+    if opcode.N and state.row_words == 1:
+        sprite_width = 8
+        rows = min(opcode.N, height - y) # Rows past the bottom edge are clipped
+
+        # Line the sprite byte up with column x of a screen row. Bits shifted
+        # past the right edge fall off the end, which clips the sprite.
+        shift = width - 8
+        screen = state.screen
+        for row in range(y, y + rows):
+            bits = (memory[I + row - y] << shift) >> x
+            collision |= screen[row] & bits
+            screen[row] ^= bits
+    else:
+        # The same, for rows of more than one word or 16 pixel sprites,
+        # a whole row at a time through State.row()
+        if opcode.N:
+            sprite_width, sprite_height = 8, opcode.N
+        else:
+            sprite_width, sprite_height = 16, 16
+        row_bytes = sprite_width // 8
+        rows = min(sprite_height, height - y)
+        shift = width - sprite_width
+        for row in range(rows):
+            start = I + row * row_bytes
+            bits = (int.from_bytes(memory[start:start + row_bytes], 'big') << shift) >> x
+            screen_row = state.row(y + row)
+            collision |= screen_row & bits
+            state.set_row(y + row, screen_row ^ bits)
+
+    state.register[0xF] = 1 if collision else 0
+    state.mark_dirty(x, y, x + sprite_width, y + rows)
+
+
+def xEX9E(state, opcode):  # 0xEX9E Skip the following instruction if the key corresponding to the hex value stored in VX is pressed.
+    if state.keypad[state.register[opcode.X]]:
+        state.pc = (state.pc + 2) % 0x1000
 
-    for y in range(len(sprite)):
-        for x in range(len(sprite[0])):
-            screen_y = state.register[opcode.Y] + y
-            screen_x = state.register[opcode.X] + x
-            try:
-                state.register[0xF] = state.register[0xF] or state.screen[screen_y*width + screen_x] & sprite[y][x]
-                state.screen[screen_y*width + screen_x] = state.screen[screen_y*width + screen_x] ^ sprite[y][x]
-            except IndexError:
-                break
 
+def xEXA1(state, opcode):  # 0xEXA1 Skip the following instruction if the key corresponding to the hex value stored in VX is not pressed.
+    if not state.keypad[state.register[opcode.X]]:
+        state.pc = (state.pc + 2) % 0x1000
 
 
 def xE(state, opcode):
-    if opcode[2:] == 0x9E: # 0xEX9E Skip the following instruction if the key corresponding to the hex value stored in VX is pressed.
-        if state.keypad[state.register[opcode.X]]:
-            state.pc = (state.pc + 2) % 0x1000 
-    else:                  # 0xEXA1 Skip the following instruction if the key corresponding to the hex value stored in VX is not pressed.
-        if not state.keypad[state.register[opcode.X]]:
-            state.pc = (state.pc + 2) % 0x1000
+    MAPPING_E.get(opcode.NN, xEXA1)(state, opcode)
+
 
 def xFX07(state, opcode):  # 0xFX07 Store the current value of the delay timer in register VX
     state.register[opcode.X] = state.delay
@@ -173,6 +248,7 @@ def xFX0A(state, opcode):  # 0xFX0A Wait for a keypress and store the result in
         state.register[opcode.X] = state.keypad.index(1)
     else:
         state.pc -= 2
+        state.idle = 1 # Nothing changes until a key is pressed
 
 
 def xFX15(state, opcode):  # 0xFX15 Set the delay timer to the value of VX
@@ -192,15 +268,21 @@ def xFX29(state, opcode):  # 0xFX29 Set I to the memory addres of the sprite dat
     state.I = state.register[opcode.X] * 5
 
 
+def xFX30(state, opcode):  # 0xFX30 Set I to the memory address of the large font sprite for the hexadecimal digit stored in VX (SUPER-CHIP)
+    state.I = chip8_state.BIG_FONT_START + state.register[opcode.X] * 10
+
+
 def xFX33(state, opcode):  # 0xFX33 Store the binary-coded decimal equivalent of the value stored in VX at addresses I, I+1, and I+2
     dec_x = format(state.register[opcode.X], '03d')
     for i in range(3):
         state.memory[state.I + i] = int(dec_x[i])
+    notify_write(state, state.I, state.I + 3)
 
 
 def xFX55(state, opcode):  # 0xFX55 Store the values of registers V0 to VX inclusive in memory starting at address I. I is set to I + X + 1 after the operation.
     for register in range(opcode.X+1):
         state.memory[state.I+register] = state.register[register]
+    notify_write(state, state.I, state.I + opcode.X + 1)
     state.I = state.I + opcode.X + 1
 
 
@@ -210,17 +292,52 @@ def xFX65(state, opcode): # 0xFX65 Fill registers V0 to VX inclusive with the va
     state.I = state.I + opcode.X + 1
 
 
+def xFX75(state, opcode):  # 0xFX75 Store the values of registers V0 to VX inclusive in the RPL user flags (SUPER-CHIP)
+    state.flags[:opcode.X + 1] = state.register[:opcode.X + 1]
+
+
+def xFX85(state, opcode):  # 0xFX85 Fill registers V0 to VX inclusive from the RPL user flags (SUPER-CHIP)
+    state.register[:opcode.X + 1] = state.flags[:opcode.X + 1]
+
+
 def xF(state, opcode):
-    mapping = {0x07: xFX07,
-               0x0A: xFX0A,
-               0x15: xFX15,
-               0x18: xFX18,
-               0x1E: xFX1E,
-               0x29: xFX29,
-               0x33: xFX33,
-               0x55: xFX55,
-               0x65: xFX65}
-    mapping[opcode[2:]](state, opcode)
+    MAPPING_F[opcode.NN](state, opcode)
+
+
+MAPPING_0 = {0x0E0: x00E0,
+             0x0EE: x00EE,
+             0x0FB: x00FB,
+             0x0FC: x00FC,
+             0x0FD: x00FD,
+             0x0FE: x00FE,
+             0x0FF: x00FF}
+MAPPING_0.update((0x0C0 + N, x00CN) for N in range(0x10))
+
+MAPPING_8 = {0x0: x8XY0,
+             0x1: x8XY1,
+             0x2: x8XY2,
+             0x3: x8XY3,
+             0x4: x8XY4,
+             0x5: x8XY5,
+             0x6: x8XY6,
+             0x7: x8XY7,
+             0xE: x8XYE}
+
+MAPPING_E = {0x9E: xEX9E,
+             0xA1: xEXA1}
+
+MAPPING_F = {0x07: xFX07,
+             0x0A: xFX0A,
+             0x15: xFX15,
+             0x18: xFX18,
+             0x1E: xFX1E,
+             0x29: xFX29,
+             0x30: xFX30,
+             0x33: xFX33,
+             0x55: xFX55,
+             0x65: xFX65,
+             0x75: xFX75,
+             0x85: xFX85}
 
 MAPPING = {0x0: x0,
            0x1: x1NNN,
@@ -240,6 +357,133 @@ MAPPING = {0x0: x0,
            0xF: xF}
 
 
+Instruction = namedtuple('Instruction', ('handler', 'opcode', 'X', 'Y', 'N', 'NN', 'NNN'))
+Instruction.__doc__ = '''A pre-decoded opcode, as stored in DECODE. Handlers are passed the
+Instruction itself, so the fields are available as opcode.X, opcode.NN etc.
+without any per-step work.'''
+
+
+def decode(word):
+    '''Return an Instruction for the 16 bit word, with the handler resolved
+all the way through the x0, x8, xE and xF sub-dispatch. Words with no
+matching handler keep the dispatcher, so they fail when executed, not
+when decoded.'''
+    X = (word & 0x0F00) >> 8
+    Y = (word & 0x00F0) >> 4
+    N = word & 0x000F
+    NN = word & 0x00FF
+    NNN = word & 0x0FFF
+
+    handler = MAPPING[word >> 12]
+    if handler is x0:
+        handler = MAPPING_0.get(NNN, x0NNN)
+    elif handler is x8:
+        handler = MAPPING_8.get(N, x8)
+    elif handler is xE:
+        handler = MAPPING_E.get(NN, xEXA1)
+    elif handler is xF:
+        handler = MAPPING_F.get(NN, xF)
+
+    return Instruction(handler, word, X, Y, N, NN, NNN)
+
+
+# Every possible 16 bit word, decoded once at import. step() only has to
+# index into this, so nothing is allocated or parsed per instruction.
+DECODE = tuple(decode(word) for word in range(0x10000))
+
+# The uninstrumented table, for when DECODE is swapped by instrument()
+PLAIN_DECODE = DECODE
+
+
+def instrument(wrap):
+    '''Swap in a dispatch table in which every handler is replaced by
+wrap(handler), and return it. wrap is called once per distinct handler.
+Instrumentation costs nothing until this is called: step() and run() just
+look up whichever table is current. chip8_compiler recompiles its blocks
+when the table changes, and they then call the wrapped handlers, except for
+the opcodes they inline, which the wrappers never see.'''
+    global DECODE
+    wrapped = {}
+    for instruction in PLAIN_DECODE:
+        if instruction.handler not in wrapped:
+            wrapped[instruction.handler] = wrap(instruction.handler)
+    DECODE = tuple(instruction._replace(handler=wrapped[instruction.handler])
+                   for instruction in PLAIN_DECODE)
+    return DECODE
+
+
+def uninstrument():
+    '''Go back to the plain dispatch table.'''
+    global DECODE
+    DECODE = PLAIN_DECODE
+
+
+# Skips that only read registers and the keypad, which can't change within a
+# spin-wait
+SPIN_SKIPS = {x3XNN, x4XNN, x5XY0, x9XY0, xEX9E, xEXA1}
+
+
+def idle_loop(state, address, target):
+    '''Return the length in opcodes of the spin-wait closed by the jump from
+address back to target, or 0 if it isn't one. A spin-wait is a loop that
+will leave state exactly as it is on every lap until the next timer tick or
+key event, so any number of whole laps can be skipped. Three shapes are
+recognised:
+
+    target: 1NNN target              (jump to itself)
+    target: skip; 1NNN target        (wait for a register or a key)
+    target: FX07; skip; 1NNN target  (wait for the delay timer)
+
+and the skip must not be taken, given the registers, keypad and delay timer
+as they are now.'''
+    memory = state.memory
+    register = state.register
+
+    def decoded(offset):
+        return PLAIN_DECODE[(memory[offset] << 8) | memory[offset + 1]]
+
+    if target == address:
+        return 1
+    elif target == address - 2:
+        skip = decoded(target)
+        if skip.handler in SPIN_SKIPS and not _skips(skip, register, state.keypad):
+            return 2
+    elif target == address - 4:
+        read, skip = decoded(target), decoded(target + 2)
+        if (read.handler is xFX07 and register[read.X] == state.delay and
+            skip.handler in SPIN_SKIPS and not _skips(skip, register, state.keypad)):
+            return 3
+    return 0
+
+
+def _skips(instruction, register, keypad):
+    '''Return whether the SPIN_SKIPS opcode instruction would skip. Also True
+if it would fail, so that it gets executed for real.'''
+    handler = instruction.handler
+    X = register[instruction.X]
+    if handler is x3XNN:
+        return X == instruction.NN
+    elif handler is x4XNN:
+        return X != instruction.NN
+    elif handler is x5XY0:
+        return X == register[instruction.Y]
+    elif handler is x9XY0:
+        return X != register[instruction.Y]
+    elif X >= len(keypad):
+        return True
+    elif handler is xEX9E:
+        return bool(keypad[X])
+    else:
+        return not keypad[X]
+
+
+def notify_write(state, start, stop):
+    '''Tell everything in state.write_watchers that memory[start:stop] was
+written to.'''
+    for watcher in state.write_watchers:
+        watcher(start, stop)
+
+
 def read_opcode(state, offset=0, advance=True):
     '''
 read_opcode(state, offset=0, advance=True)
@@ -258,11 +502,60 @@ advance: Default = True
     
 def execute_opcode(state, opcode):
     '''Perform the opcode on state.'''
-    MAPPING[opcode[0]](state, opcode)
+    instruction = DECODE[opcode]
+    instruction.handler(state, instruction)
 
 def step(state):
     '''Read and execute the next opcode.'''
-    execute_opcode(state, read_opcode(state))
+    pc = state.pc
+    memory = state.memory
+    instruction = DECODE[(memory[pc] << 8) | memory[pc + 1]]
+    state.pc = pc + 2
+    instruction.handler(state, instruction)
+
+
+def run(state, instructions):
+    '''Read and execute the next `instructions` opcodes. Returns the number
+of opcodes executed.
+
+If the program is found to be in a spin-wait (see idle_loop()), whole laps
+of it are skipped instead of executed, which leaves the same state behind.'''
+    decode = DECODE
+    memory = state.memory
+    state.idle = 0
+    for executed in range(1, instructions + 1):
+        pc = state.pc
+        instruction = decode[(memory[pc] << 8) | memory[pc + 1]]
+        state.pc = pc + 2
+        instruction.handler(state, instruction)
+        if state.idle:
+            break
+    else:
+        return instructions
+
+    # Only the position within the loop depends on how many opcodes are
+    # left, so just step through the part of a lap that doesn't fit.
+    for _ in range((instructions - executed) % state.idle):
+        step(state)
+    state.idle = 0
+    return instructions
+
+
+def tick_timers(state):
+    '''Count the delay and sound timers down by one. Called once per 60Hz
+frame.'''
+    if state.delay > 0:
+        state.delay -= 1
+    if state.sound > 0:
+        state.sound -= 1
+
+
+def run_frame(state, instructions, run=run):
+    '''Emulate one 60Hz frame: execute `instructions` opcodes with run, then
+tick the timers. Returns the number of opcodes executed.'''
+    executed = run(state, instructions)
+    tick_timers(state)
+    return executed
 
 
 class Opcode(int):
@@ -272,12 +565,14 @@ It has the following attributes:
 
 Opcode.X: The second hex digit, always the opcode's X variable, if used.
 Opcode.Y: The third hex digit, always the opcode's Y variable, if used.
+Opcode.N: The last hex digit, a constant if the opcode uses it.
 Opcode.NN: The last two hex digits, a constant if the opcode uses it.
 Opcode.NNN: The last three hex digits, an address if the opcode uses it.'''
     def __new__(cls, value):
         new_instance = int.__new__(cls, value)
         new_instance.X = (value & 0x0F00) >> 8
         new_instance.Y = (value & 0x00F0) >> 4
+        new_instance.N = value & 0x000F
         new_instance.NN = value & 0x00FF
         new_instance.NNN = value & 0x0FFF
         new_instance._hex = format(value, '04X')
@@ -0,0 +1,135 @@
+'''Recording and replay of play sessions ("movies").
+
+A movie is the snapshot the session started from, followed by every change
+to the keypad, numbered by emulated frame. Because CXNN draws from
+State.rng, which is part of the snapshot, replaying a movie with the same
+instructions per frame reproduces the session exactly, without a keyboard
+or a window:
+
+    state = chip8_movie.replay('session.c8m')
+
+The file is a MOVIE_HEADER, the snapshot, then one MOVIE_EVENT per change:
+the frame number and the keys held from that frame on, as a 16 bit mask
+with bit n set for key n. Everything is little endian.
+'''
+
+import struct
+
+import chip8_state
+import chip8_interpreter
+import chip8_compiler
+
+MOVIE_MAGIC = b'C8MV'
+MOVIE_VERSION = 1
+MOVIE_HEADER = struct.Struct('<4sBHII') # magic, version, instructions per
+                                        # frame, frames, snapshot length
+MOVIE_EVENT = struct.Struct('<IH') # frame, keypad mask
+
+
+def keypad_mask(keypad):
+    '''Pack a keypad into a 16 bit mask, with bit n set if key n is down.'''
+    mask = 0
+    for key, down in enumerate(keypad):
+        if down:
+            mask |= 1 << key
+    return mask
+
+
+class Recorder:
+    '''Records a session. Call start() once, then record() once per emulated
+frame, just before the frame is run.'''
+    def __init__(self, instructions_per_frame):
+        self.instructions_per_frame = instructions_per_frame
+        self.snapshot = None
+        self.frames = 0
+        self.events = [] # (frame, keypad mask) pairs
+        self._mask = 0
+
+    def start(self, state):
+        '''Start recording from the current contents of state.'''
+        self.snapshot = state.snapshot()
+        self.frames = 0
+        self.events = []
+        self._mask = keypad_mask(state.keypad)
+
+    def record(self, state):
+        mask = keypad_mask(state.keypad)
+        if mask != self._mask:
+            self.events.append((self.frames, mask))
+            self._mask = mask
+        self.frames += 1
+
+    def to_bytes(self):
+        if self.snapshot is None:
+            raise ValueError("Nothing has been recorded")
+        header = MOVIE_HEADER.pack(MOVIE_MAGIC, MOVIE_VERSION,
+                                   self.instructions_per_frame, self.frames,
+                                   len(self.snapshot))
+        return b''.join([header, self.snapshot] +
+                        [MOVIE_EVENT.pack(*event) for event in self.events])
+
+    def save(self, path):
+        with open(path, 'wb') as movie_file:
+            movie_file.write(self.to_bytes())
+
+
+class Player:
+    '''Plays a movie back into a state. Call start() once, then play() once
+per emulated frame, just before the frame is run.'''
+    def __init__(self, movie):
+        view = memoryview(movie)
+        try:
+            (magic, version, self.instructions_per_frame, self.frames,
+             snapshot_length) = MOVIE_HEADER.unpack_from(view)
+        except struct.error:
+            raise ValueError("Movie is truncated")
+        if magic != MOVIE_MAGIC:
+            raise ValueError("Not a movie")
+        if version != MOVIE_VERSION:
+            raise ValueError("Unsupported movie version: {}".format(version))
+
+        offset = MOVIE_HEADER.size
+        self.snapshot = bytes(view[offset:offset + snapshot_length])
+        offset += snapshot_length
+        if (len(self.snapshot) != snapshot_length or
+            (len(view) - offset) % MOVIE_EVENT.size):
+            raise ValueError("Movie has the wrong length")
+        self._events = dict(MOVIE_EVENT.iter_unpack(view[offset:]))
+        self.frame = 0
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as movie_file:
+            return cls(movie_file.read())
+
+    def start(self, state):
+        '''Put state back where the recording started.'''
+        state.restore(self.snapshot)
+        self.frame = 0
+
+    def play(self, state):
+        '''Set the keypad for the next frame. Returns False, leaving state
+alone, once every recorded frame has been played.'''
+        if self.frame >= self.frames:
+            return False
+        mask = self._events.get(self.frame)
+        if mask is not None:
+            for key in range(len(state.keypad)):
+                state.keypad[key] = (mask >> key) & 1
+        self.frame += 1
+        return True
+
+
+def replay(path, engine='interpreter'):
+    '''Play the movie at path headless on engine, 'interpreter' or
+'compiler', and return the final state.'''
+    player = Player.load(path)
+    state = chip8_state.State(b'')
+    player.start(state)
+    if engine == 'compiler':
+        run = chip8_compiler.Compiler(state).run
+    else:
+        run = chip8_interpreter.run
+    while player.play(state):
+        chip8_interpreter.run_frame(state, player.instructions_per_frame, run)
+    return state
@@ -0,0 +1,109 @@
+'''Counts how often each opcode handler and each program address is executed,
+and how much host time they take.
+
+    profiler = chip8_profile.Profiler()
+    profiler.enable()
+    ... run the program ...
+    profiler.disable()
+    print(profiler.report())
+
+While enabled, chip8_interpreter runs a dispatch table in which every handler
+is wrapped to record its timing; see chip8_interpreter.instrument(). When
+disabled, nothing is measured and nothing is slowed down. Use the interpreter
+engine, since compiled blocks inline the simplest opcodes.
+'''
+
+import time
+
+from array import array
+
+import chip8_interpreter
+
+HEATMAP_START = 0x200
+HEATMAP_STOP = 0x1000
+HEATMAP_WIDTH = 128 # Addresses per line, two to a character
+HEATMAP_SHADES = ' .:-=+*#%@'
+
+
+class Profiler:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.family_counts = {} # Handler name to executions
+        self.family_times = {}  # Handler name to seconds
+        self.address_counts = array('Q', [0]) * 0x1000
+        self.address_times = array('d', [0]) * 0x1000
+
+    def enable(self):
+        chip8_interpreter.instrument(self._wrap)
+
+    def disable(self):
+        chip8_interpreter.uninstrument()
+
+    def _wrap(self, handler):
+        name = handler.__name__
+        self.family_counts.setdefault(name, 0)
+        self.family_times.setdefault(name, 0.0)
+        family_counts = self.family_counts
+        family_times = self.family_times
+        address_counts = self.address_counts
+        address_times = self.address_times
+        perf_counter = time.perf_counter
+
+        def profiled(state, opcode):
+            address = (state.pc - 2) & 0xFFF
+            start = perf_counter()
+            handler(state, opcode)
+            elapsed = perf_counter() - start
+            family_counts[name] += 1
+            family_times[name] += elapsed
+            address_counts[address] += 1
+            address_times[address] += elapsed
+
+        profiled.__name__ = name
+        return profiled
+
+    def report(self, top=20):
+        '''Return the profile as text: the handlers sorted by total time, the
+`top` hottest addresses, and a heatmap of executions over program memory.'''
+        total_time = sum(self.family_times.values()) or 1
+        lines = ['{:8} {:>12} {:>10} {:>9} {:>6}'.format('Opcode', 'Executed', 'Time (s)', 'ns each', '%')]
+        for name in sorted(self.family_times, key=self.family_times.get, reverse=True):
+            count = self.family_counts[name]
+            if not count:
+                continue
+            elapsed = self.family_times[name]
+            lines.append('{:8} {:12} {:10.4f} {:9.0f} {:6.1f}'.format(
+                name, count, elapsed, elapsed / count * 1e9, elapsed / total_time * 100))
+
+        lines.append('')
+        lines.append('{:7} {:>12} {:>10}'.format('Address', 'Executed', 'Time (s)'))
+        hottest = sorted(range(0x1000), key=self.address_times.__getitem__, reverse=True)
+        for address in hottest[:top]:
+            if not self.address_counts[address]:
+                break
+            lines.append('0x{:03X}   {:12} {:10.4f}'.format(
+                address, self.address_counts[address], self.address_times[address]))
+
+        lines.append('')
+        lines.append(self.heatmap())
+        return '\n'.join(lines)
+
+    def heatmap(self):
+        '''Return executions from HEATMAP_START to HEATMAP_STOP as lines of
+characters, one per two byte opcode slot, darker for more executions on a
+log scale.'''
+        counts = self.address_counts
+        slots = [counts[address] + counts[address + 1]
+                 for address in range(HEATMAP_START, HEATMAP_STOP, 2)]
+        peak = max(slots) or 1
+        scale = (len(HEATMAP_SHADES) - 1) / peak.bit_length()
+        lines = []
+        per_line = HEATMAP_WIDTH // 2
+        for i in range(0, len(slots), per_line):
+            shades = ''.join(HEATMAP_SHADES[round(count.bit_length() * scale)]
+                             for count in slots[i:i + per_line])
+            line_start = HEATMAP_START + i * 2
+            lines.append('0x{:03X} |{}|'.format(line_start, shades))
+        return '\n'.join(lines)
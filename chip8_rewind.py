@@ -0,0 +1,80 @@
+'''A bounded history of emulated frames, for rewinding.
+
+Every frame is stored as a chip8_state.State snapshot, but only every
+KEYFRAME_INTERVAL'th one is kept whole. The frames in between keep just the
+pages of the snapshot that differ from their keyframe, which for most games
+is a handful of bytes of memory, the registers and the screen.
+'''
+
+from collections import deque
+
+REWIND_SECONDS = 10
+KEYFRAME_INTERVAL = 60 # Frames between full snapshots
+PAGE_SIZE = 64 # Bytes of snapshot compared and stored as one unit
+
+
+def delta(keyframe, snapshot, page_size=PAGE_SIZE):
+    '''Return the pages of snapshot that differ from keyframe, as a tuple of
+(offset, bytes) pairs.'''
+    keyframe = memoryview(keyframe)
+    snapshot = memoryview(snapshot)
+    pages = []
+    for offset in range(0, len(snapshot), page_size):
+        page = snapshot[offset:offset + page_size]
+        if page != keyframe[offset:offset + page_size]:
+            pages.append((offset, page.tobytes()))
+    return tuple(pages)
+
+
+def apply_delta(keyframe, pages):
+    '''Rebuild a snapshot from its keyframe and the pages from delta().'''
+    snapshot = bytearray(keyframe)
+    for offset, page in pages:
+        snapshot[offset:offset + len(page)] = page
+    return snapshot
+
+
+class Rewind:
+    '''A ring buffer holding the last `seconds` of frames. Call push() once
+per frame and pop() to step back one frame at a time.'''
+    def __init__(self, seconds=REWIND_SECONDS, frame_rate=60,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        # Each entry is (keyframe, pages), with pages None for keyframes.
+        # Deltas keep a reference to their keyframe, so a keyframe stays
+        # alive for as long as anything still depends on it.
+        self._frames = deque(maxlen=int(seconds * frame_rate))
+        self._keyframe_interval = keyframe_interval
+        self._keyframe = None
+        self._since_keyframe = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, state):
+        '''Record the current contents of state as the newest frame.'''
+        snapshot = state.snapshot()
+        if (self._keyframe is None or
+            self._since_keyframe >= self._keyframe_interval or
+            len(snapshot) != len(self._keyframe)):
+            self._keyframe = snapshot
+            self._since_keyframe = 0
+            self._frames.append((snapshot, None))
+        else:
+            self._frames.append((self._keyframe, delta(self._keyframe, snapshot)))
+        self._since_keyframe += 1
+
+    def pop(self, state):
+        '''Restore the newest frame into state and forget it. Returns False,
+leaving state alone, if there are no frames left.'''
+        if not self._frames:
+            return False
+        keyframe, pages = self._frames.pop()
+        if pages is None:
+            state.restore(keyframe)
+        else:
+            state.restore(apply_delta(keyframe, pages))
+        return True
+
+    def clear(self):
+        self._frames.clear()
+        self._keyframe = None
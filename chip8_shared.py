@@ -0,0 +1,187 @@
+'''Runs the emulation core in a process of its own, talking to the front end
+through a block of shared memory instead of sharing a GIL with it.
+
+The block starts with the fields in SHARED_FIELDS, then the keypad, then the
+screen as 64 bit words, in the layout of chip8_state.State.screen, with
+room for the largest resolution:
+
+    sequence      Even while a frame is complete, odd while the core is
+                  writing one. Readers check it before and after copying,
+                  and throw the copy away if it changed.
+    frame         Frames emulated so far.
+    width, height The screen size, as of the end of the frame.
+    delay, sound  The timers, as of the end of the frame.
+    beeps         Incremented whenever the sound timer is started, with
+    beep_length   set to the frames it was started for.
+    quit          Set by the front end to stop the core.
+    status        Set by the core: RUNNING, then STOPPED or CRASHED.
+
+The keypad belongs to the front end, which writes pressed keys straight
+into it. The core copies it into its state at the start of every frame.
+'''
+
+import time
+import struct
+import traceback
+
+from array import array
+from multiprocessing import shared_memory
+
+import chip8_state
+import chip8_interpreter
+import chip8_compiler
+
+# Header fields in order, with their struct formats. Each field is written
+# by only one side, and on its own, so neither side can undo the other's
+# writes.
+SHARED_FIELDS = (('sequence', 'Q'),
+                 ('frame', 'Q'),
+                 ('beeps', 'I'),
+                 ('width', 'B'),
+                 ('height', 'B'),
+                 ('delay', 'B'),
+                 ('sound', 'B'),
+                 ('beep_length', 'B'),
+                 ('quit', 'B'),
+                 ('status', 'B'))
+
+SHARED_OFFSETS = {}
+_offset = 0
+for _name, _format in SHARED_FIELDS:
+    SHARED_OFFSETS[_name] = (_offset, struct.Struct('<' + _format))
+    _offset += struct.calcsize(_format)
+
+KEYPAD_OFFSET = _offset
+SCREEN_OFFSET = KEYPAD_OFFSET + 16
+SCREEN_SIZE = max(width * height for width, height in chip8_state.RESOLUTIONS) // 8
+
+RUNNING = 1
+STOPPED = 2
+CRASHED = 3
+
+
+class SharedFrame:
+    '''The shared block. Create it with no name in the front end, then
+attach to it by name in the core.'''
+    def __init__(self, name=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=SCREEN_OFFSET + SCREEN_SIZE)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.name = self._shm.name
+        self.keypad = self._shm.buf[KEYPAD_OFFSET:KEYPAD_OFFSET + 16]
+        self._screen = self._shm.buf[SCREEN_OFFSET:]
+        self._beeps = 0
+        if self._owner:
+            self.set('status', RUNNING)
+
+    def get(self, field):
+        offset, packer = SHARED_OFFSETS[field]
+        return packer.unpack_from(self._shm.buf, offset)[0]
+
+    def set(self, field, value):
+        offset, packer = SHARED_OFFSETS[field]
+        packer.pack_into(self._shm.buf, offset, value)
+
+    def publish(self, state, frame, beep_length=0):
+        '''Write the screen and timers of state as frame number `frame`,
+counting a beep if beep_length isn't 0. Only called by the core.'''
+        sequence = self.get('sequence') + 1
+        self.set('sequence', sequence) # Odd: being written
+        screen = memoryview(state.screen).cast('B')
+        self._screen[:len(screen)] = screen
+        self.set('width', state.SCREEN_WIDTH)
+        self.set('height', state.SCREEN_HEIGHT)
+        self.set('frame', frame)
+        self.set('delay', state.delay)
+        self.set('sound', state.sound)
+        if beep_length:
+            self._beeps += 1
+            self.set('beep_length', beep_length)
+            self.set('beeps', self._beeps & 0xFFFFFFFF)
+        self.set('sequence', sequence + 1) # Even: complete
+
+    def read(self, state, last_sequence):
+        '''Copy the newest complete frame into state, marking the rows that
+changed as dirty, if its sequence number isn't last_sequence. The screen of
+state is switched to the resolution of the frame if needed. Returns
+(sequence, beeps, beep_length), or None if there was nothing new or the
+core was halfway through writing.'''
+        sequence = self.get('sequence')
+        if not sequence or sequence == last_sequence or sequence % 2:
+            return None # Nothing published yet, nothing new, or half written
+        # The one copy, of at most a kilobyte, so that a frame the core
+        # starts overwriting meanwhile can be thrown away whole
+        width, height = self.get('width'), self.get('height')
+        words = array('Q', self._screen[:width * height // 8].tobytes())
+        delay, sound = self.get('delay'), self.get('sound')
+        beeps, beep_length = self.get('beeps'), self.get('beep_length')
+        if self.get('sequence') != sequence:
+            return None
+
+        if (width, height) != (state.SCREEN_WIDTH, state.SCREEN_HEIGHT):
+            state.set_resolution(width, height)
+        if state.screen != words:
+            changed = [i for i in range(len(words)) if words[i] != state.screen[i]]
+            state.screen[:] = words
+            state.mark_dirty(0, changed[0] // state.row_words,
+                             state.SCREEN_WIDTH, changed[-1] // state.row_words + 1)
+        state.delay, state.sound = delay, sound
+        return sequence, beeps, beep_length
+
+    def close(self):
+        '''Detach, and free the block if this is the side that created it.'''
+        self.keypad.release()
+        self._screen.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def core(name, program, instructions_per_frame, engine, frame_rate, uncapped):
+    '''The core process: run program, publishing every frame to the
+SharedFrame called name, until the front end sets quit.'''
+    frame = SharedFrame(name)
+    state = chip8_state.State(program)
+    if engine == 'compiler':
+        run = chip8_compiler.Compiler(state).run
+    else:
+        run = chip8_interpreter.run
+
+    frame_time = 1 / frame_rate
+    beeping = False
+    count = 0
+    deadline = time.perf_counter()
+    try:
+        while not frame.get('quit'):
+            state.keypad[:] = frame.keypad
+            run(state, instructions_per_frame)
+
+            beep_length = 0
+            if state.sound > 0:
+                if not beeping:
+                    beep_length = state.sound
+                    beeping = True
+            else:
+                beeping = False
+
+            chip8_interpreter.tick_timers(state)
+            count += 1
+            frame.publish(state, count, beep_length)
+
+            if not uncapped:
+                deadline += frame_time
+                remaining = deadline - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+                elif remaining < -frame_time:
+                    deadline = time.perf_counter()
+        frame.set('status', STOPPED)
+    except BaseException:
+        frame.set('status', CRASHED)
+        traceback.print_exc()
+    finally:
+        frame.close()
@@ -1,3 +1,9 @@
+import sys
+import random
+import struct
+
+from array import array
+
 FONT = (0xF0, 0x90, 0x90, 0x90, 0xF0, # 0
         0x20, 0x60, 0x20, 0x20, 0x70, # 1
         0xF0, 0x10, 0xF0, 0x80, 0xF0, # 2
@@ -15,31 +21,267 @@ FONT = (0xF0, 0x90, 0x90, 0x90, 0xF0, # 0
         0xF0, 0x80, 0xF0, 0x80, 0xF0, # E
         0xF0, 0x80, 0xF0, 0x80, 0x80) # F
 
+# The SUPER-CHIP large font for FX30: 8x10 pixel digits, loaded after FONT
+BIG_FONT_START = 0x50
+BIG_FONT = (0xFF, 0xFF, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, # 0
+            0x18, 0x78, 0x78, 0x18, 0x18, 0x18, 0x18, 0x18, 0xFF, 0xFF, # 1
+            0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, # 2
+            0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, # 3
+            0xC3, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, 0x03, 0x03, 0x03, 0x03, # 4
+            0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, # 5
+            0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, # 6
+            0xFF, 0xFF, 0x03, 0x03, 0x06, 0x0C, 0x18, 0x18, 0x18, 0x18, # 7
+            0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, # 8
+            0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, # 9
+            0x7E, 0xFF, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, 0xC3, 0xC3, 0xC3, # A
+            0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC, # B
+            0x3C, 0xFF, 0xC3, 0xC0, 0xC0, 0xC0, 0xC0, 0xC3, 0xFF, 0x3C, # C
+            0xFC, 0xFE, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xFE, 0xFC, # D
+            0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, # E
+            0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xC0, 0xC0) # F
+
+STACK_SIZE = 16 # Nested subroutine calls
+FLAG_COUNT = 16 # SUPER-CHIP RPL user flags, for FX75 and FX85
+
+# Screen sizes, (width, height): CHIP-8, and SUPER-CHIP high resolution
+LORES = (64, 32)
+HIRES = (128, 64)
+RESOLUTIONS = (LORES, HIRES)
+
+# Snapshots are a fixed header followed by the raw contents of memory, the
+# registers, the stack, the keypad, the RPL flags, the screen words and the
+# Mersenne Twister state of State.rng, in that order. Everything is little
+# endian. Version 1 snapshots, from before the flags, can still be restored.
+SNAPSHOT_MAGIC = b'C8ST'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sBBBHHBBB?d') # magic, version, width,
+                                                 # height, I, pc, delay,
+                                                 # sound, sp, gauss_next
+                                                 # is set, gauss_next
+
 class State:
-    def __init__(self, program): # Creates a state object with all values empty
-        self.SCREEN_WIDTH = 64
-        self.SCREEN_HEIGHT = 32
+    # Everything lives in fixed size bytearray and array buffers, which can
+    # be shared without copying through memoryview.
+    __slots__ = ('SCREEN_WIDTH', 'SCREEN_HEIGHT', 'row_words',
+                 'register', 'I', 'pc', 'delay', 'sound', 'stack', 'sp',
+                 'keypad', 'flags', 'write_watchers', 'dirty', 'idle', 'rng',
+                 'memory', 'screen')
+
+    def __init__(self, program, seed=None): # Creates a state object with all values empty
+        self.SCREEN_WIDTH, self.SCREEN_HEIGHT = LORES
 
-        self.register = [0x00] * 16 # 16 registers, each 8 bits. Reigisters go from V0 - VF, but VF doubles as a carry flag.
+        self.register = bytearray(16) # 16 registers, each 8 bits. Reigisters go from V0 - VF, but VF doubles as a carry flag.
         self.I = 0x0000 # The address register. 16 bits.
         self.pc = 0x200  # Points to the current opcode
         self.delay = 0x00 # When set by 0xFX07, counts down at 60hz
         self.sound = 0x00 # When set by 0xFX18, counts down at 60hz while emitting a tone.
-        self.stack = []
-        self.keypad = [0] * 16
+        self.stack = array('H', [0]) * STACK_SIZE # Return addresses, stack[:sp] are in use
+        self.sp = 0
+        self.keypad = bytearray(16)
+        self.flags = bytearray(FLAG_COUNT) # Saved and loaded by 0xFX75 and 0xFX85
+        self.write_watchers = [] # Called as watcher(start, stop) after an opcode writes to memory[start:stop]
+        self.dirty = None # Bounding box of screen changes, see mark_dirty()
+        self.idle = 0 # Opcodes in the spin-wait being run, see chip8_interpreter.idle_loop()
+        self.rng = random.Random(seed) # For 0xCXNN. Seeded from the OS if seed is None
 
         self.init_memory(program)
         self.init_screen()
 
     def load_data(self, data, data_start):
         '''Load data into memory, starting at datastart'''
-        for i, byte in enumerate(data):
-            self.memory[data_start+i] = byte
+        data = bytes(data)
+        if data_start + len(data) > len(self.memory):
+            raise ValueError("{} bytes don't fit in memory at 0x{:03X}".format(len(data), data_start))
+        self.memory[data_start:data_start + len(data)] = data
 
     def init_memory(self, program):
-        self.memory = [0x00] * 0x1000 # Default 4096 (0x1000) memory locations, each 8 bits (1 byte).
+        self.memory = bytearray(0x1000) # Default 4096 (0x1000) memory locations, each 8 bits (1 byte).
         self.load_data(program, 0x200)
         self.load_data(FONT, 0)
+        self.load_data(BIG_FONT, BIG_FONT_START)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        '''Create a new State from the bytes returned by State.snapshot()'''
+        state = cls(b'')
+        state.restore(snapshot)
+        return state
+
+    def snapshot(self):
+        '''Return the complete machine state as bytes, in the format described
+by SNAPSHOT_HEADER. The state of self.rng is included, so restoring a
+snapshot also restores what CXNN will produce next.'''
+        rng_version, rng_internal, gauss_next = self.rng.getstate()
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                      self.SCREEN_WIDTH, self.SCREEN_HEIGHT,
+                                      self.I, self.pc, self.delay, self.sound,
+                                      self.sp, gauss_next is not None,
+                                      gauss_next or 0.0)
+        return b''.join((header,
+                         self.memory,
+                         self.register,
+                         _little_endian(self.stack),
+                         self.keypad,
+                         self.flags,
+                         _little_endian(self.screen),
+                         _little_endian(array('I', rng_internal))))
+
+    def restore(self, snapshot):
+        '''Overwrite this state in place with a snapshot from
+State.snapshot(). Raises ValueError if the snapshot is invalid or from an
+incompatible version. The screen is switched to the resolution of the
+snapshot if needed. The rows of the screen that change are marked dirty,
+and write_watchers are told about the memory that changes.'''
+        view = memoryview(snapshot)
+        try:
+            (magic, version, width, height, I, pc, delay, sound, sp,
+             has_gauss, gauss_next) = SNAPSHOT_HEADER.unpack_from(view)
+        except struct.error:
+            raise ValueError("Snapshot is truncated")
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a snapshot")
+        if version not in (1, SNAPSHOT_VERSION):
+            raise ValueError("Unsupported snapshot version: {}".format(version))
+        if (width, height) not in RESOLUTIONS:
+            raise ValueError("Snapshot is for a {}x{} screen".format(width, height))
+        if sp > STACK_SIZE:
+            raise ValueError("Snapshot has a stack pointer past the stack")
+
+        # Everything is checked before the first change to self, so that an
+        # invalid snapshot leaves the state as it was
+        sizes = [len(self.memory), len(self.register),
+                 len(memoryview(self.stack).cast('B')), len(self.keypad)]
+        if version > 1:
+            sizes.append(len(self.flags))
+        sizes.append(width * height // 8) # The screen
+        rng = array('I')
+        rng_offset = SNAPSHOT_HEADER.size + sum(sizes)
+        if len(view) - rng_offset != 625 * rng.itemsize:
+            raise ValueError("Snapshot has the wrong length")
+        rng.frombytes(view[rng_offset:])
+        if sys.byteorder == 'big':
+            rng.byteswap()
+        if rng[-1] > 624: # The Mersenne Twister's position, see random.setstate()
+            raise ValueError("Snapshot has an invalid random number generator state")
+
+        if (width, height) != (self.SCREEN_WIDTH, self.SCREEN_HEIGHT):
+            self.set_resolution(width, height)
+        if version == 1:
+            self.flags[:] = bytes(FLAG_COUNT)
+            buffers = (self.memory, self.register, self.stack, self.keypad,
+                       self.screen)
+        else:
+            buffers = (self.memory, self.register, self.stack, self.keypad,
+                       self.flags, self.screen)
+
+        # Only what actually changes is reported, so that restoring often,
+        # as rewind and run-ahead do, keeps compiled code and the renderer's
+        # work to a minimum
+        offset = SNAPSHOT_HEADER.size
+        written = _changed_range(self.memory, view[offset:offset + sizes[0]])
+        old_screen = array('Q', self.screen)
+        for buffer, size in zip(buffers, sizes):
+            memoryview(buffer).cast('B')[:] = view[offset:offset + size]
+            offset += size
+        for buffer in (self.stack, self.screen):
+            if sys.byteorder == 'big':
+                buffer.byteswap()
+
+        self.I = I
+        self.pc = pc
+        self.delay = delay
+        self.sound = sound
+        self.sp = sp
+        self.rng.setstate((3, tuple(rng), gauss_next if has_gauss else None))
+
+        words = [i for i in range(len(self.screen)) if self.screen[i] != old_screen[i]]
+        if words:
+            self.mark_dirty(0, words[0] // self.row_words,
+                            self.SCREEN_WIDTH, words[-1] // self.row_words + 1)
+        if written:
+            for watcher in self.write_watchers:
+                watcher(*written)
 
     def init_screen(self):
-        self.screen = [0x00]*self.SCREEN_HEIGHT*self.SCREEN_WIDTH
+        # Each row is row_words 64 bit words, SCREEN_WIDTH bits in all: one
+        # word at 64x32, two at 128x64. The most significant bit of the
+        # first word is the leftmost pixel. row() and set_row() deal in
+        # whole rows as ints.
+        self.row_words = self.SCREEN_WIDTH // 64
+        self.screen = array('Q', [0x00])*(self.SCREEN_HEIGHT*self.row_words)
+        self.mark_dirty(0, 0, self.SCREEN_WIDTH, self.SCREEN_HEIGHT)
+
+    def set_resolution(self, width, height):
+        '''Switch the screen to width x height, one of RESOLUTIONS, and clear
+it.'''
+        if (width, height) not in RESOLUTIONS:
+            raise ValueError("Unsupported resolution: {}x{}".format(width, height))
+        self.SCREEN_WIDTH = width
+        self.SCREEN_HEIGHT = height
+        self.dirty = None # The old box may not fit the new screen
+        self.init_screen()
+
+    def row(self, y):
+        '''Return row y of the screen as an int, SCREEN_WIDTH bits wide.'''
+        words = self.row_words
+        if words == 1:
+            return self.screen[y]
+        bits = 0
+        for word in self.screen[y*words:(y + 1)*words]:
+            bits = (bits << 64) | word
+        return bits
+
+    def set_row(self, y, bits):
+        '''Overwrite row y of the screen with bits, as returned by row().'''
+        words = self.row_words
+        if words == 1:
+            self.screen[y] = bits
+            return
+        for i in range((y + 1)*words - 1, y*words - 1, -1):
+            self.screen[i] = bits & 0xFFFFFFFFFFFFFFFF
+            bits >>= 64
+
+    def pixel(self, x, y):
+        '''Return the pixel at (x, y), 0 or 1.'''
+        return (self.row(y) >> (self.SCREEN_WIDTH - 1 - x)) & 1
+
+    def row_pixels(self, y, x0=0, x1=None):
+        '''Expand row y of the screen into a list of pixels, each 0 or 1,
+from column x0 up to but not including column x1.'''
+        if x1 is None:
+            x1 = self.SCREEN_WIDTH
+        row = self.row(y)
+        last = self.SCREEN_WIDTH - 1
+        return [(row >> (last - x)) & 1 for x in range(x0, x1)]
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        '''Grow self.dirty to cover the pixels from (x0, y0) up to but not
+including (x1, y1). self.dirty is None when the screen hasn't changed since
+the renderer last cleared it, and an (x0, y0, x1, y1) box otherwise.'''
+        x1 = min(x1, self.SCREEN_WIDTH)
+        y1 = min(y1, self.SCREEN_HEIGHT)
+        if self.dirty is None:
+            self.dirty = (x0, y0, x1, y1)
+        else:
+            d = self.dirty
+            self.dirty = (min(x0, d[0]), min(y0, d[1]), max(x1, d[2]), max(y1, d[3]))
+
+
+def _changed_range(old, new, page_size=64):
+    '''Return (start, stop) covering the pages of page_size bytes that differ
+between the buffers old and new, or None if they are the same.'''
+    old = memoryview(old)
+    new = memoryview(new)
+    if old == new:
+        return None
+    pages = [offset for offset in range(0, len(old), page_size)
+             if old[offset:offset + page_size] != new[offset:offset + page_size]]
+    return pages[0], min(pages[-1] + page_size, len(old))
+
+
+def _little_endian(buffer):
+    '''Return an array's contents in little endian byte order.'''
+    if sys.byteorder == 'big':
+        buffer = array(buffer.typecode, buffer)
+        buffer.byteswap()
+    return buffer
@@ -0,0 +1,150 @@
+'''A cheap execution trace, for finding out what led up to a crash.
+
+    tracer = chip8_trace.Tracer()
+    tracer.enable()
+    ... run the program ...
+    tracer.dump('trace.c8t')
+
+While enabled, every executed opcode appends a TRACE_RECORD to a ring
+buffer holding the last `size` of them: the address it was at, the opcode,
+I afterwards, and the register it changed with its new value. Nothing is
+formatted until the trace is decoded, offline:
+
+    python3 chip8_trace.py trace.c8t
+
+Like chip8_profile, this works by swapping in a wrapped dispatch table with
+chip8_interpreter.instrument(), so only one of the two can be enabled at a
+time. With the compiler engine, the opcodes that blocks inline (register
+arithmetic, loads of I, jumps and skips) are left out of the trace, so use
+the interpreter engine for a complete one.
+'''
+
+import struct
+import argparse
+
+import chip8_interpreter
+
+TRACE_SIZE = 65536 # Records kept, the last ones executed
+TRACE_MAGIC = b'C8TR'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sBI') # magic, version, record count
+TRACE_RECORD = struct.Struct('<HHHBB') # pc, opcode, I, register, value
+NO_REGISTER = 0xFF # In place of the register when none was changed
+
+
+class Tracer:
+    def __init__(self, size=TRACE_SIZE):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self._buffer = bytearray(self.size * TRACE_RECORD.size)
+        self._next = 0 # Index of the record to overwrite next
+        self.count = 0 # Records written, including overwritten ones
+
+    def enable(self):
+        chip8_interpreter.instrument(self._wrap)
+
+    def disable(self):
+        chip8_interpreter.uninstrument()
+
+    def _wrap(self, handler):
+        pack_into = TRACE_RECORD.pack_into
+        record_size = TRACE_RECORD.size
+
+        def traced(state, opcode):
+            pc = (state.pc - 2) & 0xFFFF
+            register = state.register
+            before = bytes(register)
+            try:
+                handler(state, opcode)
+            finally:
+                # Written even if the opcode raised, so that the trace ends
+                # with the one that crashed
+                if register[opcode.X] != before[opcode.X]:
+                    changed = opcode.X
+                elif register != before:
+                    changed = next(i for i in range(len(before)) if register[i] != before[i])
+                else:
+                    changed = NO_REGISTER
+                pack_into(self._buffer, self._next * record_size,
+                          pc, opcode.opcode, state.I & 0xFFFF,
+                          changed, 0 if changed == NO_REGISTER else register[changed])
+                self._next = (self._next + 1) % self.size
+                self.count += 1
+
+        traced.__name__ = handler.__name__
+        return traced
+
+    def to_bytes(self):
+        '''Return the records in the buffer, oldest first, packed together.'''
+        if self.count <= self.size:
+            return bytes(self._buffer[:self.count * TRACE_RECORD.size])
+        split = self._next * TRACE_RECORD.size
+        return bytes(self._buffer[split:] + self._buffer[:split])
+
+    def records(self):
+        '''Return the records in the buffer as tuples, oldest first.'''
+        return list(TRACE_RECORD.iter_unpack(self.to_bytes()))
+
+    def dump(self, path):
+        '''Write the records in the buffer to the file at path.'''
+        records = self.to_bytes()
+        with open(path, 'wb') as trace_file:
+            trace_file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                               len(records) // TRACE_RECORD.size))
+            trace_file.write(records)
+
+
+def load(path):
+    '''Return the records in the trace file at path as tuples, oldest first.'''
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    try:
+        magic, version, count = TRACE_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("Trace is truncated")
+    if magic != TRACE_MAGIC:
+        raise ValueError("Not a trace")
+    if version != TRACE_VERSION:
+        raise ValueError("Unsupported trace version: {}".format(version))
+    if len(data) != TRACE_HEADER.size + count * TRACE_RECORD.size:
+        raise ValueError("Trace has the wrong length")
+    return list(TRACE_RECORD.iter_unpack(data[TRACE_HEADER.size:]))
+
+
+def format_record(record, descriptions):
+    '''Render a record as one line of text, described by descriptions, a
+chip8_debug.Descriptions.'''
+    pc, opcode, I, register, value = record
+    if register == NO_REGISTER:
+        change = ''
+    else:
+        change = 'V{:X}={:02X}'.format(register, value)
+    try:
+        description = descriptions[opcode].split('\n')[0]
+    except KeyError:
+        description = 'Unknown opcode.'
+    return '{:03X}  {:04X}  I={:03X}  {:6}  {}'.format(pc, opcode, I, change, description)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print a CHIP-8 execution trace.')
+    parser.add_argument('trace', help='trace file written by Tracer.dump()')
+    parser.add_argument('--last', type=int, metavar='N',
+                        help='only print the last N records')
+    args = parser.parse_args(argv)
+
+    # Only needed here, and chip8_debug pulls in the whole interpreter
+    import chip8_debug
+    descriptions = chip8_debug.Descriptions()
+
+    records = load(args.trace)
+    if args.last:
+        records = records[-args.last:]
+    for record in records:
+        print(format_record(record, descriptions))
+
+
+if __name__ == '__main__':
+    main()
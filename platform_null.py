@@ -0,0 +1,129 @@
+'''A headless platform layer. Nothing is drawn or played and no devices are
+opened, so programs can run at full speed on machines without a display or
+sound card. Input comes from a script instead of a keyboard.
+
+Options are read from option_dict['null']:
+
+    'input_script': An iterable of (tick, keycode, type) tuples. The event
+                    action bound to keycode is returned, as
+                    chip8_input.Action(type, action), from the tick'th call
+                    to Input.get_actions(), counting from 0.
+    'quit_after':   If not None, a QUIT event is returned from this tick on.
+
+load_input_script() reads an input script from a text file, with one event
+per line:
+
+    60 down 5        # Tick, then down or up and a keycode
+    64 up 5
+    600 quit
+'''
+
+import chip8_input
+
+
+class Interface:
+    def __init__(self, state, option_dict):
+        self.option_dict = option_dict
+
+        self.video = Video(self, state)
+        self.input = Input(self)
+        self.audio = Audio(self)
+
+
+class Video:
+    def __init__(self, interface, state):
+        self.frames = 0
+        self.changed_frames = 0
+        self.screen = state.screen
+
+    def update_screen(self, state):
+        '''Count the frame and keep a reference to the framebuffer, which is
+available afterwards as Video.screen. It is a list of rows, in the same
+packed form as chip8_state.State.screen.'''
+        self.frames += 1
+        if state.dirty is not None:
+            self.changed_frames += 1
+            state.dirty = None
+        self.screen = state.screen
+
+
+SCRIPT_EVENT_TYPES = {'down': chip8_input.KEYDOWN,
+                      'up':   chip8_input.KEYUP,
+                      'quit': chip8_input.QUIT}
+
+
+def load_input_script(path):
+    '''Return the input script in the file at path as a list of (tick,
+keycode, type) tuples, for the 'input_script' option. Blank lines and
+anything after a # are ignored. Raises ValueError on a malformed line or
+an unknown key.'''
+    script = []
+    with open(path) as script_file:
+        for number, line in enumerate(script_file, 1):
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            try:
+                tick = int(fields[0])
+                event_type = SCRIPT_EVENT_TYPES[fields[1]]
+                if event_type == chip8_input.QUIT:
+                    keycode, = fields[2:] or [None]
+                else:
+                    keycode, = fields[2:]
+            except (ValueError, IndexError, KeyError):
+                raise ValueError("{}, line {}: expected 'TICK down|up KEY' "
+                                 "or 'TICK quit'".format(path, number))
+            if keycode is not None:
+                try:
+                    keycode = chip8_input.normalize_keycode(keycode)
+                except chip8_input.KeyCodeError as error:
+                    raise ValueError("{}, line {}: {}".format(path, number, error))
+            script.append((tick, keycode, event_type))
+    return script
+
+
+class Input:
+    def __init__(self, interface):
+        options = interface.option_dict.get('null', {})
+        self.tick = 0
+        self._table = {}
+        self._quit_after = options.get('quit_after')
+        self._script = {}
+        for tick, keycode, event_type in options.get('input_script', ()):
+            if event_type != chip8_input.QUIT:
+                keycode = chip8_input.normalize_keycode(keycode)
+            event = chip8_input.Event(event_type, keycode)
+            self._script.setdefault(tick, []).append(event)
+
+    def bind_keymap(self, keymap):
+        '''Compile keymap into the table used by get_actions().'''
+        self._table = chip8_input.compile_keymap(keymap)
+
+    def get_actions(self):
+        events = self._script.pop(self.tick, [])
+        actions = []
+        for event in events:
+            if event.type == chip8_input.QUIT:
+                actions.append(chip8_input.Action(chip8_input.QUIT, None))
+            else:
+                action = self._table.get(chip8_input.split_keycode(event.keycode))
+                if action is not None:
+                    actions.append(chip8_input.Action(event.type, action))
+        if self._quit_after is not None and self.tick >= self._quit_after:
+            actions.append(chip8_input.Action(chip8_input.QUIT, None))
+        self.tick += 1
+        return actions
+
+    def push(self, event):
+        '''Queue event, a chip8_input.Event with a normalized keycode, to be
+handled by the next call to get_actions.'''
+        self._script.setdefault(self.tick, []).append(event)
+
+
+class Audio:
+    def __init__(self, interface):
+        self.beeps = []
+
+    def beep(self, length):
+        '''Record a beep of length milliseconds in Audio.beeps'''
+        self.beeps.append(length)
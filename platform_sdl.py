@@ -1,13 +1,13 @@
 import time
 import sys
-import io
 import ctypes
 
-from math import sin, pi
+from math import sin, pi, gcd
+from operator import or_
+from functools import reduce
 
 import sdl2
 import sdl2.ext
-from PIL import Image
 
 import chip8_input
 
@@ -204,15 +204,25 @@ sdl2.SDLK_KP_OCTAL: "kp_octal",
 sdl2.SDLK_KP_DECIMAL: "kp_decimal",
 sdl2.SDLK_KP_HEXADECIMAL: "kp_hexadecimal"}
 
-SDL_KMOD_TO_MOD = {sdl2.KMOD_NONE: "",
-                  sdl2.KMOD_LCTRL: "ctrl+",
-                  sdl2.KMOD_LSHIFT: "shift+",
-                  sdl2.KMOD_LALT: "alt+",
-                  sdl2.KMOD_LGUI: "super+",
-                  sdl2.KMOD_RCTRL: "ctrl+",
-                  sdl2.KMOD_RSHIFT: "shift+",
-                  sdl2.KMOD_RALT: "alt+",
-                  sdl2.KMOD_RGUI: "super+"}
+GENERIC_TO_SDL = {generic: sym for sym, generic in SDL_TO_GENERIC.items()}
+
+SDL_KMOD_TO_MOD = {sdl2.KMOD_LCTRL:  chip8_input.MOD_CTRL,
+                   sdl2.KMOD_LSHIFT: chip8_input.MOD_SHIFT,
+                   sdl2.KMOD_LALT:   chip8_input.MOD_ALT,
+                   sdl2.KMOD_LGUI:   chip8_input.MOD_SUPER,
+                   sdl2.KMOD_RCTRL:  chip8_input.MOD_CTRL,
+                   sdl2.KMOD_RSHIFT: chip8_input.MOD_SHIFT,
+                   sdl2.KMOD_RALT:   chip8_input.MOD_ALT,
+                   sdl2.KMOD_RGUI:   chip8_input.MOD_SUPER}
+
+KMOD_MASK = sdl2.KMOD_CTRL | sdl2.KMOD_SHIFT | sdl2.KMOD_ALT | sdl2.KMOD_GUI
+
+# SDL modifier state, masked with KMOD_MASK, to chip8_input modifier mask.
+# Left and right modifiers are the same, and num lock, caps lock and the
+# like are ignored.
+MODMASKS = tuple(reduce(or_, (modifier for kmod, modifier in SDL_KMOD_TO_MOD.items()
+                             if modstate & kmod), 0)
+                 for modstate in range(KMOD_MASK + 1))
 
 
 class Interface:
@@ -223,7 +233,7 @@ class Interface:
         self.option_dict = option_dict
 
         self.video = Video(self, state)
-        self.input = Input()
+        self.input = Input(self.video)
         self.audio = Audio(self)
 
 
@@ -244,56 +254,104 @@ class Video:
                                        flags=sdl2.SDL_WINDOW_RESIZABLE)
         self._window.show()
 
-        logical_size = (state.SCREEN_WIDTH,
-                        state.SCREEN_HEIGHT)
-
-        self._renderer = sdl2.ext.Renderer(self._window, logical_size=logical_size)
-        self._texture_renderer = sdl2.ext.TextureSpriteRenderSystem(self._renderer)
-        self._sprite_factory = sdl2.ext.SpriteFactory(renderer=self._renderer)
+        self._renderer = sdl2.ext.Renderer(self._window,
+                                           logical_size=(state.SCREEN_WIDTH,
+                                                         state.SCREEN_HEIGHT))
+        self._colours = [0xFF000000 | r << 16 | g << 8 | b
+                         for r, g, b in self.palette]
+        self._texture = None
+        self._create_texture(state.SCREEN_WIDTH, state.SCREEN_HEIGHT)
+
+    def _create_texture(self, width, height):
+        # One streaming texture per screen resolution, filled from a pixel
+        # buffer that is also kept between frames. Each palette entry is
+        # converted to a ARGB8888 pixel once, in __init__.
+        if self._texture is not None:
+            sdl2.SDL_DestroyTexture(self._texture)
+        self._size = (width, height)
+        self._renderer.logical_size = self._size
+        self._texture = sdl2.SDL_CreateTexture(self._renderer.sdlrenderer,
+                                               sdl2.SDL_PIXELFORMAT_ARGB8888,
+                                               sdl2.SDL_TEXTUREACCESS_STREAMING,
+                                               width, height)
+        self._pixels = (ctypes.c_uint32 * (width * height))()
+        self._pitch = width * ctypes.sizeof(ctypes.c_uint32)
 
     def update_screen(self, state):
-        im_screen = Image.new('RGB', 
-                              (state.SCREEN_WIDTH, 
-                               state.SCREEN_HEIGHT))
-        im_screen.putdata([self.palette[p] for p in state.screen])
-        bytesio_screen = io.BytesIO()
-        im_screen.save(bytesio_screen, format='BMP')
-        bytesio_screen.seek(0)
+        '''Redraw the window if state.dirty says the screen has changed.
+Only the dirty region is converted and uploaded to the texture.'''
+        if state.dirty is None:
+            return
+        x0, y0, x1, y1 = state.dirty
+        state.dirty = None
+
+        if (state.SCREEN_WIDTH, state.SCREEN_HEIGHT) != self._size:
+            # Switched by 00FE or 00FF, which also marked the whole screen
+            # dirty
+            self._create_texture(state.SCREEN_WIDTH, state.SCREEN_HEIGHT)
+
+        width = state.SCREEN_WIDTH
+        colours = self._colours
+        pixels = self._pixels
+        for y in range(y0, y1):
+            start = y*width
+            pixels[start + x0:start + x1] = [colours[p] for p in
+                                             state.row_pixels(y, x0, x1)]
 
-        texture = self._sprite_factory.from_object(bytesio_screen)
-        self._texture_renderer.render(texture, x=0, y=0)
+        rect = sdl2.SDL_Rect(x0, y0, x1 - x0, y1 - y0)
+        offset = (y0*width + x0) * ctypes.sizeof(ctypes.c_uint32)
+        sdl2.SDL_UpdateTexture(self._texture, rect,
+                               ctypes.byref(pixels, offset), self._pitch)
+
+        self.present()
+
+    def present(self):
+        '''Show the texture in the window again, as it was last updated.'''
+        renderer = self._renderer.sdlrenderer
+        sdl2.SDL_RenderCopy(renderer, self._texture, None, None)
+        sdl2.SDL_RenderPresent(renderer)
 
 
 
 class Input:
-    def get_events(self):
-        sdl2_events = sdl2.ext.get_events()
-        generic_events = []
-        for event in sdl2_events:
+    def __init__(self, video):
+        self._event = sdl2.SDL_Event()
+        self._table = {}
+        self._video = video # Re-presented when the window needs redrawing
+
+    def bind_keymap(self, keymap):
+        '''Compile keymap into a table of (SDL keysym, modmask) to action,
+used by get_actions().'''
+        self._table = {(GENERIC_TO_SDL[key], modmask): action
+                       for (key, modmask), action in chip8_input.compile_keymap(keymap).items()
+                       if key in GENERIC_TO_SDL}
+
+    def get_actions(self):
+        '''Drain the SDL event queue and return the bound actions of the key
+events in it, as chip8_input.Action tuples. If the window was uncovered or
+resized, it is redrawn from the last frame, since update_screen() only draws
+when the screen changes.'''
+        event = self._event
+        table = self._table
+        actions = []
+        while sdl2.SDL_PollEvent(ctypes.byref(event)):
             if event.type == sdl2.SDL_QUIT:
-                generic_events.append(chip8_input.Event(chip8_input.QUIT, ''))
-                return generic_events
-            elif event.type == sdl2.SDL_KEYDOWN:
-                key = event.key.keysym.sym
-                if key in SDL_TO_GENERIC.keys():
-                    keycode = chip8_input.normalize_keycode(self._modstate() +
-                                                SDL_TO_GENERIC[key])
-                    generic_events.append(chip8_input.Event(chip8_input.KEYDOWN, keycode))
-            elif event.type == sdl2.SDL_KEYUP:
-                key = event.key.keysym.sym
-                if key in SDL_TO_GENERIC.keys():
-                    keycode = chip8_input.normalize_keycode(self._modstate() +
-                                                SDL_TO_GENERIC[key])
-                    generic_events.append(chip8_input.Event(chip8_input.KEYUP, keycode))
-                                          
-        return tuple(generic_events)
-
-    def _modstate(self):
-        modstate = sdl2.SDL_GetModState()
-        string = []
-        for k in SDL_KMOD_TO_MOD.keys():
-            string.append(SDL_KMOD_TO_MOD[modstate & k])
-        return ''.join(string)
+                actions.append(chip8_input.Action(chip8_input.QUIT, None))
+                break
+            elif event.type == sdl2.SDL_KEYDOWN or event.type == sdl2.SDL_KEYUP:
+                if event.key.repeat:
+                    continue
+                keysym = event.key.keysym
+                action = table.get((keysym.sym, MODMASKS[keysym.mod & KMOD_MASK]))
+                if action is not None:
+                    event_type = chip8_input.KEYDOWN if event.type == sdl2.SDL_KEYDOWN else chip8_input.KEYUP
+                    actions.append(chip8_input.Action(event_type, action))
+            elif event.type == sdl2.SDL_WINDOWEVENT:
+                if event.window.event in (sdl2.SDL_WINDOWEVENT_EXPOSED,
+                                          sdl2.SDL_WINDOWEVENT_SIZE_CHANGED):
+                    self._video.present()
+
+        return actions
 
 
 class Audio:
@@ -305,16 +363,8 @@ class Audio:
         self._amplitude = int(options['volume'] * 127)
         self._tonehz = options['tonehz']
 
-        if options['wavetype'] == 'square':
-            self._phase = 0
-            self._running_sample_index = 0
-            square_wave_period = samples_per_second / self._tonehz
-            self._half_square_wave_period = int(square_wave_period / 2)
-
-            self._generate_sample = self._generate_square
-        elif options['wavetype'] == 'sine':
-            self._v = 0
-            self._generate_sample = self._generate_sine
+        self._build_wavetable(options['wavetype'], samples_per_second)
+        self._phase = 0 # Index into the wavetable of the next sample to play
 
         audio_callback = sdl2.SDL_AudioCallback(self._callback)
         self._spec = sdl2.SDL_AudioSpec(freq=samples_per_second,
@@ -327,29 +377,49 @@ class Audio:
         sdl2.SDL_PauseAudioDevice(self._devid, 0)
 
 
-    def _generate_sine(self):
-        sample = int(self._amplitude * 
-                     sin(self._v * 2 * pi / self._spec.freq))
-        self._v += self._tonehz
-        return sample
-
+    def _build_wavetable(self, wavetype, samples_per_second):
+        '''Precompute the samples for the tone. The table covers the shortest
+whole number of periods that is also a whole number of samples, so looping
+over it keeps the pitch exact. It is stored twice over, so that any run of
+up to self._period samples can be copied out of it in one go.'''
+        if self._tonehz == int(self._tonehz):
+            periods = gcd(samples_per_second, int(self._tonehz))
+            self._period = samples_per_second // periods
+        else:
+            self._period = round(samples_per_second / self._tonehz)
+
+        samples = []
+        for i in range(self._period):
+            t = i * self._tonehz / samples_per_second # In periods
+            if wavetype == 'square':
+                sample = self._amplitude if int(t * 2) % 2 else -self._amplitude
+            else:
+                sample = int(self._amplitude * sin(t * 2 * pi))
+            samples.append(sample & 0xFF) # AUDIO_S8, as unsigned bytes
 
-    def _generate_square(self):
-        self._running_sample_index += 1
-        if self._running_sample_index % self._half_square_wave_period == 0:
-            self._phase += 1
-        sample = self._amplitude  if self._phase % 2 else -self._amplitude
-        return sample
+        table = bytes(samples) * 2
+        self._wavetable = (ctypes.c_ubyte * len(table)).from_buffer_copy(table)
 
 
     def _callback(self, notused, stream, length):
-        for i in range(length):
-            if self._samples_left > 0:
-                sample = self._generate_sample()
-                stream[i] = ctypes.c_ubyte(sample)
-                self._samples_left -= 1
-            else:
-                stream[i] = ctypes.c_ubyte(0)
+        # Runs on the SDL audio thread, so this avoids per sample Python
+        # work: the tone is copied out of the wavetable in bulk, and any
+        # remainder is filled with silence.
+        address = ctypes.cast(stream, ctypes.c_void_p).value
+        wavetable = ctypes.addressof(self._wavetable)
+
+        playing = min(self._samples_left, length)
+        self._samples_left -= playing
+
+        written = 0
+        while written < playing:
+            count = min(playing - written, self._period)
+            ctypes.memmove(address + written, wavetable + self._phase, count)
+            self._phase = (self._phase + count) % self._period
+            written += count
+
+        if playing < length:
+            ctypes.memset(address + playing, 0, length - playing)
 
 
     def beep(self, length):